@@ -42,41 +42,1693 @@ relevant class and function definitions, as opposed to their implementation).
 ------------------------------------------------------------------------------
 """
 import array
+import ast
+import asyncio
+import atexit
+import bisect
+import contextlib
+import contextvars
+import copy
+import hashlib
+import heapq
+import inspect
+import io
 import json
+import mmap
+import os
+import queue
 import random
+import runpy
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
 import time
+import warnings
+import weakref
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 STATE_FILE_DEFAULT = 'microbit_state.json'
+STATE_BACKEND_DEFAULT = 'json'
+WRITE_BEHIND_DEFAULT = False
+WRITE_BEHIND_LATENCY_DEFAULT = 100
+STATE_WATCH_DEFAULT = False
+JOURNAL_MAX_SIZE_DEFAULT = 65536
+TIME_MODE_DEFAULT = 'real'
+TIME_SCALE_DEFAULT = 1.0
+MONOTONIC_RUNNING_TIME_DEFAULT = False
+IDLE_SLEEPS_DEFAULT = 3
+SCENARIO_FILE_DEFAULT = ''
+SCENARIO_STREAM_DEFAULT = False
+DISPLAY_SINK_DEFAULT = 'text'
+DISPLAY_BUFFER_SIZE_DEFAULT = 0
+DISPLAY_BUFFER_LATENCY_DEFAULT = 100
 try:
-    from microbit_stub_settings import state_file
+    import microbit_stub_settings as _settings
 except ImportError:
-    state_file = STATE_FILE_DEFAULT
+    _settings = None
+
+# the names of the settings, which are also the names of their values
+_setting_names = []
+
+def _setting(name, default):
+    """Returns the value of the named setting.
+    
+    A MICROBIT_STUB_<NAME> environment variable takes precedence over the
+    microbit_stub_settings module, which takes precedence over the default.
+    Environment variable values are converted to the type of the default.
+    """
+    if name not in _setting_names:
+        _setting_names.append(name)
+    value = os.environ.get('MICROBIT_STUB_' + name.upper())
+    
+    if value is None:
+        return getattr(_settings, name, default)
+    
+    if isinstance(default, bool):
+        return value.lower() in ['1', 'true', 'yes', 'on']
+    elif isinstance(default, int):
+        return int(value)
+    elif isinstance(default, float):
+        return float(value)
+    
+    return value
+
+state_file = _setting('state_file', STATE_FILE_DEFAULT)
+state_backend = _setting('state_backend', STATE_BACKEND_DEFAULT)
+write_behind = _setting('write_behind', WRITE_BEHIND_DEFAULT)
+write_behind_latency = _setting('write_behind_latency',
+                                WRITE_BEHIND_LATENCY_DEFAULT)
+state_watch = _setting('state_watch', STATE_WATCH_DEFAULT)
+journal_max_size = _setting('journal_max_size', JOURNAL_MAX_SIZE_DEFAULT)
+time_mode = _setting('time_mode', TIME_MODE_DEFAULT)
+time_scale = _setting('time_scale', TIME_SCALE_DEFAULT)
+monotonic_running_time = _setting('monotonic_running_time', 
+                                    MONOTONIC_RUNNING_TIME_DEFAULT)
+idle_sleeps = _setting('idle_sleeps', IDLE_SLEEPS_DEFAULT)
+scenario_file = _setting('scenario_file', SCENARIO_FILE_DEFAULT)
+scenario_stream = _setting('scenario_stream', SCENARIO_STREAM_DEFAULT)
+display_sink = _setting('display_sink', DISPLAY_SINK_DEFAULT)
+display_buffer_size = _setting('display_buffer_size', 
+                                DISPLAY_BUFFER_SIZE_DEFAULT)
+display_buffer_latency = _setting('display_buffer_latency', 
+                                    DISPLAY_BUFFER_LATENCY_DEFAULT)
+
+
+__all__ = [ 'panic', 'reset', 'running_time', 'sleep', 
+            'Accelerometer', 'accelerometer',
+            'compass',
+            'button_a', 'button_b',
+            'display',
+            'Image',
+            'i2c',
+            'pin0', 'pin1', 'pin2', 'pin3', 'pin4', 'pin5', 'pin6', 'pin7',
+            'pin8', 'pin9', 'pin10', 'pin11', 'pin12', 'pin13', 'pin14',
+            'pin15', 'pin16', 'pin19', 'pin20',
+            'uart', 
+            'state',
+        ]
+
+# objects that hold back output (write-behind state backends and display 
+# sinks), which are flushed at exit without being kept alive until then
+_flushed_at_exit = weakref.WeakSet()
+
+def _flush_at_exit():
+    for target in list(_flushed_at_exit):
+        target.flush()
+        
+atexit.register(_flush_at_exit)
+
+
+""" State ---------------------------------------------------------------- """
+""" This is for the emulation not part of the microbit module ------------ """
+class StateBackend:
+    """Base class for the storage backends used by State.
+    
+    This is for emulation purposes - backends are not part of the microbit 
+    API. A backend is initialised with a dictionary of default state values
+    (including the initial state_file) and stores state values by key. State
+    checks keys and values for validity before passing them to a backend.
+    
+    Subclasses must implement get, set, snapshot and version. The other 
+    methods do nothing or are implemented in terms of get and set unless 
+    overridden.
+    """
+    __STATE_FILE_KEY = 'state_file'
+    
+    def get(self, key, default=0):
+        """Returns the value for the key, or default if the key is unknown.
+        """
+        raise NotImplementedError
+    
+    def set(self, key, value):
+        """Sets the value for the key.
+        """
+        raise NotImplementedError
+    
+    def batch(self, changes):
+        """Sets the value for each key in the changes dictionary.
+        """
+        for k, v in changes.items():
+            self.set(k, v)
+            
+    def press(self, key, presses_key=None):
+        """Sets the value for key to 1 and increments the value for 
+        presses_key (unless presses_key is None).
+        """
+        changes = { key:1 }
+        if presses_key is not None:
+            changes[presses_key] = self.get(presses_key) + 1
+        self.batch(changes)
+            
+    def flush(self):
+        """Makes any changes held back by the backend visible to other 
+        processes.
+        """
+        pass
+    
+    def version(self):
+        """Returns a value that changes whenever the stored state changes.
+        """
+        raise NotImplementedError
+    
+    def snapshot(self):
+        """Returns a dictionary of all state values.
+        """
+        raise NotImplementedError
+    
+    def load(self):
+        """Loads state changed by other processes and follows the state_file 
+        chain, if the backend supports these.
+        """
+        pass
+    
+    def dump(self):
+        """Saves state, if the backend supports this.
+        """
+        pass
+    
+    def reset(self, values):
+        """Sets every value to 0, except for those given in the values 
+        dictionary and state_file, which is unchanged.
+        """
+        self.batch({ k:values.get(k, 0) for k in self.snapshot().keys()
+                        if k != StateBackend.__STATE_FILE_KEY })
+        
+    def stats(self):
+        """Returns a dictionary of backend specific counters.
+        """
+        return {}
+    
+
+class MemoryBackend(StateBackend):
+    """Stores state in memory only. 
+    
+    State is not shared with other processes and the state_file is ignored.
+    """
+    def __init__(self, data):
+        self.data = dict(data)
+        self.__version = 0
+        
+    def get(self, key, default=0):
+        return self.data.get(key, default)
+    
+    def set(self, key, value):
+        self.data[key] = value
+        self.__version = self.__version + 1
+    
+    def batch(self, changes):
+        self.data.update(changes)
+        self.__version = self.__version + 1
+    
+    def version(self):
+        return self.__version
+    
+    def snapshot(self):
+        return dict(self.data)
+
+
+class StateFileWatcher:
+    """Watches state files for changes.
+    
+    This is for emulation purposes - it is used by JsonFileBackend when 
+    state_watch is True, so that state files are only loaded after they 
+    have been written. On Linux, files are watched with inotify (by watching
+    their directories, so that files that are replaced are also seen). 
+    Elsewhere, or if inotify is not available, the watcher falls back to
+    polling the modification time, size and inode of the files.
+    
+    The watcher is dirty when a watched file may have changed since it was
+    last cleaned. A new watcher is dirty.
+    """
+    __IN_MODIFY = 0x00000002
+    __IN_CLOSE_WRITE = 0x00000008
+    __IN_MOVED_TO = 0x00000080
+    __IN_CREATE = 0x00000100
+    __IN_DELETE = 0x00000200
+    __IN_Q_OVERFLOW = 0x00004000
+    __IN_NONBLOCK = 0o4000
+    __IN_CLOEXEC = 0o2000000
+    __IN_MASK = __IN_MODIFY | __IN_CLOSE_WRITE | __IN_MOVED_TO | __IN_CREATE \
+                | __IN_DELETE
+    __EVENT = struct.Struct('iIII')
+    __RACY_NS = 100000000
+    
+    def __init__(self, use_inotify=True):
+        """Initialise the watcher, using inotify if use_inotify is True and
+        inotify is available.
+        """
+        self.__dirty = True
+        self.__fd = None
+        self.__dirs = {}
+        self.__names = set()
+        self.__fingerprints = {}
+        
+        if use_inotify:
+            try:
+                import ctypes
+                self.__libc = ctypes.CDLL(None, use_errno=True)
+                fd = self.__libc.inotify_init1(StateFileWatcher.__IN_NONBLOCK
+                                                | StateFileWatcher.__IN_CLOEXEC)
+                if fd >= 0:
+                    self.__fd = fd
+            except Exception:
+                pass
+            
+        self.inotify = self.__fd is not None
+        
+    def watch(self, filenames):
+        """Add the named files to the watched files.
+        """
+        for filename in filenames:
+            if not filename:
+                continue
+            
+            path = os.path.abspath(filename)
+            directory, name = os.path.split(path)
+            
+            if self.inotify:
+                if directory not in self.__dirs.values():
+                    wd = self.__libc.inotify_add_watch(self.__fd, 
+                                directory.encode(), StateFileWatcher.__IN_MASK)
+                    if wd < 0:
+                        self.__dirty = True
+                        continue
+                    self.__dirs[wd] = directory
+                self.__names.add((directory, name))
+            elif path not in self.__fingerprints:
+                self.__fingerprints[path] = StateFileWatcher.__fingerprint(path)
+                
+    def __fingerprint(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        
+        if time.time_ns() - stat.st_mtime_ns < StateFileWatcher.__RACY_NS:
+            # may be changed again without changing the fingerprint
+            return time.time_ns()
+        
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+                
+    def dirty(self):
+        """Returns True if a watched file may have changed since the watcher
+        was last cleaned.
+        """
+        if self.__dirty:
+            return True
+        
+        if self.inotify:
+            self.__read_events()
+        else:
+            for path, fingerprint in self.__fingerprints.items():
+                if StateFileWatcher.__fingerprint(path) != fingerprint:
+                    self.__dirty = True
+                    break
+                
+        return self.__dirty
+    
+    def __read_events(self):
+        while not self.__dirty:
+            try:
+                buf = os.read(self.__fd, 65536)
+            except BlockingIOError:
+                return
+            
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = StateFileWatcher.__EVENT.unpack_from(
+                                                                buf, offset)
+                offset = offset + StateFileWatcher.__EVENT.size
+                name = buf[offset:offset + length].rstrip(b'\0')
+                offset = offset + length
+                
+                if mask & StateFileWatcher.__IN_Q_OVERFLOW \
+                        or (self.__dirs.get(wd), name.decode()) in self.__names:
+                    self.__dirty = True
+            
+    def clean(self):
+        """Mark the watcher as not dirty, e.g. before loading the watched 
+        files.
+        """
+        if self.inotify:
+            self.__read_events()
+        else:
+            for path in self.__fingerprints:
+                self.__fingerprints[path] = StateFileWatcher.__fingerprint(path)
+            
+        self.__dirty = False
+        
+    def close(self):
+        """Stop watching files.
+        """
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+            
+    def __del__(self):
+        self.close()
+        
+
+class JsonFileBackend(StateBackend):
+    """Stores state in json format state files (the default backend).
+    
+    State is loaded from the current state file before every change and 
+    dumped to the file after it, so that changes by other processes using 
+    the same state file are included. If the state file cannot be read or 
+    written, state is held in memory.
+    
+    In write-behind mode, state changes are collected in memory and only
+    written to the state file by flush(). A flush happens on sleep(), on
+    reset(), at interpreter exit and when the oldest unwritten change is
+    older than the write-behind latency (in milliseconds).
+    
+    If watch is True, the current and next state files are watched by a 
+    StateFileWatcher and loading does nothing unless they have been written.
+    If the watcher uses inotify, get() also loads state as soon as a 
+    watched file has been written.
+    
+    On initialisation, every file in the state_file chain is parsed once 
+    (stopping at the end of the chain or where it cycles back to a file 
+    already parsed). The parsed contents of each file are kept in memory 
+    and a file is only parsed again if it changes.
+    """
+    __STATE_FILE_KEY = 'state_file'
+    __RACY_NS = 100000000
+    
+    def __init__(self, data, write_behind=write_behind,
+                    write_behind_latency=write_behind_latency, 
+                    watch=state_watch):
+        self.data = dict(data)
+        self.__watcher = StateFileWatcher() if watch else None
+        self.__loaded = None
+        self.__write_behind = write_behind
+        self.__write_behind_latency = write_behind_latency
+        self.__pending = {}
+        self.__timer = None
+        self.__lock = threading.RLock()
+        self.__cache = {}
+        self.__version = 0
+        self.__stats = { 'flushes': 0, 'load_hits': 0, 'load_misses': 0,
+                            'preloaded': 0 }
+        
+        self.__preload()
+        self.load()
+        
+        if self.__write_behind:
+            _flushed_at_exit.add(self)
+            
+    def get(self, key, default=0):
+        if self.__watcher is not None and self.__watcher.inotify:
+            with self.__lock:
+                if self.__watcher.dirty():
+                    self.load()
+                
+        return self.data.get(key, default)
+    
+    def set(self, key, value):
+        """Sets the value for the key.
+        
+        In write-behind mode, the change is visible to get() immediately but
+        is not written to the state file until the next flush().
+        """
+        self.batch({ key:value })
+        
+    def batch(self, changes):
+        with self.__lock:
+            self.__version = self.__version + 1
+            if self.__write_behind:
+                self.data.update(changes)
+                self.__pending.update(changes)
+                self.__schedule_flush()
+            else:
+                self.load()
+                self.data.update(changes)
+                self.dump()
+
+    def __schedule_flush(self):
+        if self.__timer is None and self.__write_behind_latency is not None:
+            self.__timer = threading.Timer(self.__write_behind_latency/1000,
+                                            self.flush)
+            self.__timer.daemon = True
+            self.__timer.start()
+            
+    def __cancel_flush(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+            
+    def flush(self):
+        """Write any state changes held back in write-behind mode to the
+        current state file.
+        
+        Changes made by other processes since the last load are merged: the 
+        state file is loaded and the held back changes are applied on top 
+        before dumping. This method has no effect if there are no held back 
+        changes.
+        """
+        with self.__lock:
+            self.__cancel_flush()
+
+            if self.__pending:
+                pending = self.__pending
+                self.__pending = {}
+                self.load()
+                self.data.update(pending)
+                self.dump()
+                
+    def version(self):
+        return self.__version
+    
+    def snapshot(self):
+        return dict(self.data)
+
+    def stats(self):
+        """Returns a dictionary of state file counters.
+        
+        flushes is the number of times state has been written to the state 
+        file. load_hits and load_misses are the number of loads that found 
+        the state file unchanged (and so did not parse it) and changed, 
+        respectively. preloaded is the number of files in the state_file 
+        chain that were parsed on initialisation.
+        """
+        return dict(self.__stats)
+    
+    def load(self):
+        """Load state from the current state file.
+        
+        Errors and exceptions during loading are ignored. This method has 
+        no effect if the state file is empty, has an invalid format, does
+        not exist etc.
+
+        In write-behind mode, changes that have not yet been flushed are
+        re-applied to the loaded state.
+
+        The file is only parsed if it has changed since it was last parsed 
+        (as indicated by its modification time, size and inode). Otherwise 
+        state is restored from the previously parsed contents, which are 
+        kept for every file in the state_file chain and for every file 
+        dumped. The contents of a file modified less than 100ms before it 
+        is loaded are compared with the previous contents, because a 
+        subsequent change within the resolution of file modification times
+        would not change its fingerprint. They are only parsed again if 
+        they differ.
+        
+        If state files are watched, this method has no effect unless the 
+        state file has been written since it was last loaded.
+        """
+        with self.__lock:
+            filename = self.data[JsonFileBackend.__STATE_FILE_KEY]
+            
+            if self.__watcher is not None:
+                if filename == self.__loaded and not self.__watcher.dirty():
+                    self.__stats['load_hits'] += 1
+                    return
+                
+                self.__watcher.watch([filename])
+                self.__watcher.clean()
+                self.__loaded = filename
+                
+            try:
+                self.data = dict(self.__read(filename))
+            except:
+                pass
+
+            self.data.update(self.__pending)
+            
+            if self.__watcher is not None:
+                self.__watcher.watch(
+                        [self.data[JsonFileBackend.__STATE_FILE_KEY]])
+
+    def __read(self, filename):
+        # the parsed contents of the file, which is only parsed if it has
+        # changed since it was last parsed
+        stat = os.stat(filename)
+        fingerprint = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        cached = self.__cache.get(filename)
+        text = None
+        
+        if cached is not None and cached[0] == fingerprint:
+            if time.time_ns() - stat.st_mtime_ns >= JsonFileBackend.__RACY_NS:
+                self.__stats['load_hits'] += 1
+                return cached[1]
+            
+            # a recent change may not change the fingerprint, so compare the
+            # contents (e.g. of our own dump) without parsing them
+            with open(filename) as f:
+                text = f.read()
+            if text == cached[2]:
+                self.__stats['load_hits'] += 1
+                return cached[1]
+        
+        self.__stats['load_misses'] += 1
+        self.__version = self.__version + 1
+        if text is None:
+            with open(filename) as f:
+                text = f.read()
+        snapshot = json.loads(text)
+        self.__cache[filename] = (fingerprint, snapshot, text)
+            
+        return snapshot
+    
+    def __preload(self):
+        # parse each file in the state_file chain once
+        chain = []
+        filename = self.data[JsonFileBackend.__STATE_FILE_KEY]
+        
+        while isinstance(filename, str) and filename not in chain:
+            try:
+                snapshot = self.__read(filename)
+            except Exception:
+                break
+            chain.append(filename)
+            filename = snapshot.get(JsonFileBackend.__STATE_FILE_KEY) \
+                        if isinstance(snapshot, dict) else None
+            
+        self.__stats['preloaded'] = len(chain)
+
+    def dump(self):
+        """Dump state to the current state file.
+        
+        Errors and exceptions during dumping are ignored. This method has 
+        no effect if the state file is empty, has an invalid format, does
+        not exist etc.
+        """
+        with self.__lock:
+            self.__stats['flushes'] += 1
+            filename = self.data[JsonFileBackend.__STATE_FILE_KEY]
+            self.__cache.pop(filename, None)
+            try:
+                text = json.dumps(self.data, sort_keys=True, indent=4,
+                                    ensure_ascii=False)
+                with open(filename, 'w') as f:
+                    f.write(text)
+                    
+                # what was written is the parsed contents of the file, so
+                # that loading it again does not parse it
+                stat = os.stat(filename)
+                self.__cache[filename] = ((stat.st_mtime_ns, stat.st_size, 
+                                            stat.st_ino), dict(self.data), 
+                                            text)
+            except (OSError, TypeError):
+                pass
+                
+    def reset(self, values):
+        """Reset all state values and dump to the current state file.
+        
+        Any changes held back in write-behind mode are discarded.
+        """
+        with self.__lock:
+            self.__cancel_flush()
+            self.__pending = {}
+            self.__version = self.__version + 1
+            filename = self.data[JsonFileBackend.__STATE_FILE_KEY]
+            self.data = { k:values.get(k, 0) for k in self.data.keys() }
+            self.data[JsonFileBackend.__STATE_FILE_KEY] = filename
+            self.dump()
+            
+
+class MappedFileBackend(StateBackend):
+    """Stores state in a fixed-layout binary file that is memory-mapped for 
+    reading and writing.
+    
+    The binary file is stored next to the json state file it corresponds to,
+    with the extension .mmap. If the binary file does not exist, it is 
+    created from the json state file (or from default values if the json 
+    state file cannot be loaded).
+    
+    Each state value is a 64 bit integer at a fixed offset, so that reads 
+    and writes are single memory accesses that are immediately visible to
+    other processes mapping the same file. A header holds the name of the
+    next json state file, so that state_file chaining works as it does for
+    json state files: loading maps the next file in the chain, if it is not
+    the current file.
+    
+    The header also holds a change counter that is used as a sequence lock:
+    it is odd while a change is being written, so that snapshot() can retry
+    until it reads all values without an intervening change. Writers
+    exclude each other with a lock on a lock file (the binary file itself),
+    where fcntl is available, and with a thread lock. If a writer stopped
+    part way through a change (leaving the counter odd), the next writer
+    completes the counter and snapshot() reads with writers excluded and
+    makes the counter even again.
+    """
+    KEYS = ('accelerometer_x', 'accelerometer_y', 'accelerometer_z',
+            'button_a', 'button_a_presses', 'button_b', 'button_b_presses',
+            'pin0', 'pin1', 'pin2', 'pin3', 'pin4', 'pin5', 'pin6', 'pin7',
+            'pin8', 'pin9', 'pin10', 'pin11', 'pin12', 'pin13', 'pin14',
+            'pin15', 'pin16', 'pin19', 'pin20',
+            'power')
+    EXTENSION = '.mmap'
+    MAGIC = b'MBS1'
+    __STATE_FILE_KEY = 'state_file'
+    __HEADER = struct.Struct('<4sQ256s')
+    __VALUE = struct.Struct('<q')
+    __VERSION_OFFSET = 4
+    __NEXT_OFFSET = 12
+    __VALUES_OFFSET = 272
+    __OFFSETS = dict(zip(KEYS, range(__VALUES_OFFSET, 
+                        __VALUES_OFFSET + len(KEYS) * __VALUE.size, 
+                        __VALUE.size)))
+    __RETRIES = 10000
+    SIZE = __VALUES_OFFSET + len(KEYS) * __VALUE.size
+    
+    def __init__(self, data):
+        """Map the binary state for the initial json state_file, creating it
+        if necessary.
+        
+        Raises OSError if the binary state cannot be created or mapped and 
+        ValueError if it is not valid binary state.
+        """
+        self.__defaults = dict(data)
+        self.filename = data[MappedFileBackend.__STATE_FILE_KEY]
+        self.__lock = threading.Lock()
+        self.__lock_file = None
+        self.__buf = self.__attach(self.filename)
+        self.__open_lock(self.filename)
+        
+    def path(filename):
+        """Returns the path of the binary file for the named json state file.
+        """
+        return os.path.splitext(filename)[0] + MappedFileBackend.EXTENSION
+    
+    def lock_path(self, filename):
+        """Returns the path of the file locked by writers of the binary state
+        for the named json state file.
+        """
+        return MappedFileBackend.path(filename)
+    
+    def __open_lock(self, filename):
+        lock_file = open(self.lock_path(filename), 'ab')
+        if self.__lock_file is not None:
+            self.__lock_file.close()
+        self.__lock_file = lock_file
+        
+    @contextlib.contextmanager
+    def __writing(self):
+        # exclude other writers, in this and other processes
+        with self.__lock:
+            if fcntl:
+                fcntl.flock(self.__lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(self.__lock_file.fileno(), fcntl.LOCK_UN)
+    
+    def __attach(self, filename):
+        buf = self.map(filename)
+            
+        if bytes(buf[:len(MappedFileBackend.MAGIC)]) != MappedFileBackend.MAGIC:
+            self.unmap(buf)
+            raise ValueError('invalid binary state for ' + filename)
+        
+        return buf
+    
+    def map(self, filename):
+        """Returns a writable buffer of the binary state for the named json 
+        state file, creating the binary state if necessary.
+        """
+        path = MappedFileBackend.path(filename)
+        
+        if not os.path.exists(path):
+            # create under a temporary name and link into place so that a 
+            # concurrent process never maps a partly written file
+            tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(self.image(filename))
+                
+            try:
+                os.link(tmp, path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp)
+            
+        with open(path, 'r+b') as f:
+            return mmap.mmap(f.fileno(), MappedFileBackend.SIZE)
+        
+    def unmap(self, buf):
+        """Releases a buffer returned by map.
+        """
+        buf.close()
+    
+    def image(self, filename):
+        """Returns the initial binary state for the named json state file, 
+        from the json state file or from default values if the json state 
+        file cannot be loaded.
+        """
+        data = dict(self.__defaults)
+        data[MappedFileBackend.__STATE_FILE_KEY] = filename
+        
+        try:
+            with open(filename) as f:
+                data.update(json.load(f))
+        except:
+            pass
+        
+        buf = bytearray(MappedFileBackend.SIZE)
+        MappedFileBackend.__HEADER.pack_into(buf, 0, 
+                    MappedFileBackend.MAGIC, 0,
+                    data[MappedFileBackend.__STATE_FILE_KEY].encode('utf-8'))
+        for k, offset in MappedFileBackend.__OFFSETS.items():
+            MappedFileBackend.__VALUE.pack_into(buf, offset, 
+                                                    int(data.get(k, 0)))
+        return buf
+            
+    def __set_version(self, version):
+        MappedFileBackend.__VALUE.pack_into(self.__buf, 
+                    MappedFileBackend.__VERSION_OFFSET, version)
+        
+    def version(self):
+        """Returns the change counter, which is incremented before and after
+        every change.
+        """
+        return MappedFileBackend.__VALUE.unpack_from(self.__buf, 
+                                    MappedFileBackend.__VERSION_OFFSET)[0]
+    
+    def get(self, key, default=0):
+        """Returns the value for the key, or default if the key is unknown.
+        
+        The value of state_file is the name of the next json state file.
+        """
+        if key == MappedFileBackend.__STATE_FILE_KEY:
+            start = MappedFileBackend.__NEXT_OFFSET
+            end = MappedFileBackend.__VALUES_OFFSET
+            return bytes(self.__buf[start:end]).rstrip(b'\0').decode('utf-8')
+        
+        offset = MappedFileBackend.__OFFSETS.get(key)
+        if offset is None:
+            return default
+        
+        return MappedFileBackend.__VALUE.unpack_from(self.__buf, offset)[0]
+    
+    def set(self, key, value):
+        """Sets the value for the key. This method has no effect if the key
+        is unknown.
+        
+        The value of state_file is the name of the next json state file.
+        """
+        self.batch({ key:value })
+        
+    def batch(self, changes):
+        with self.__writing():
+            self.__write(changes)
+            
+    def __write(self, changes):
+        # with writers excluded, an odd version was left by a writer that 
+        # stopped part way through a change, so is already odd
+        version = self.version()
+        if version % 2 == 0:
+            version = version + 1
+        
+        self.__set_version(version)
+        try:
+            for key, value in changes.items():
+                if key == MappedFileBackend.__STATE_FILE_KEY:
+                    start = MappedFileBackend.__NEXT_OFFSET
+                    end = MappedFileBackend.__VALUES_OFFSET
+                    name = value.encode('utf-8')
+                    if len(name) > end - start:
+                        raise ValueError('state file name too long')
+                    self.__buf[start:end] = name.ljust(end - start, b'\0')
+                else:
+                    offset = MappedFileBackend.__OFFSETS.get(key)
+                    if offset is not None:
+                        MappedFileBackend.__VALUE.pack_into(self.__buf, 
+                                                            offset, value)
+        finally:
+            self.__set_version(version + 1)
+        
+    def reset(self, values):
+        self.batch({ k:values.get(k, 0) for k in MappedFileBackend.KEYS })
+        
+    def snapshot(self):
+        """Returns a dictionary of all state values that is consistent, 
+        i.e. not changed part way through being read.
+        """
+        for i in range(MappedFileBackend.__RETRIES):
+            version = self.version()
+            if version % 2 == 0:
+                data = self.__read()
+                if self.version() == version:
+                    return data
+            time.sleep(0)
+        
+        # a writer stopped part way through a change (or changes are too 
+        # frequent to read between), so read with writers excluded
+        with self.__writing():
+            data = self.__read()
+            version = self.version()
+            if version % 2 == 1:
+                self.__set_version(version + 1)
+        return data
+    
+    def __read(self):
+        data = { k:self.get(k) for k in MappedFileBackend.KEYS }
+        data[MappedFileBackend.__STATE_FILE_KEY] = \
+                        self.get(MappedFileBackend.__STATE_FILE_KEY)
+        return data
+    
+    def load(self):
+        filename = self.get(MappedFileBackend.__STATE_FILE_KEY)
+        if filename != self.filename:
+            try:
+                buf = self.__attach(filename)
+            except (OSError, ValueError):
+                return
+            
+            self.unmap(self.__buf)
+            self.__buf = buf
+            self.filename = filename
+            self.__open_lock(filename)
+        
+    def dump(self):
+        """Flush changes to the underlying file.
+        """
+        if isinstance(self.__buf, mmap.mmap):
+            self.__buf.flush()
+        
+
+class SharedMemoryBackend(MappedFileBackend):
+    """Stores state in a named shared memory block, with the same fixed 
+    layout as MappedFileBackend.
+    
+    The name of the block is derived from the absolute path of the json 
+    state file, so that every process using the same state file attaches to
+    the same block. If the block does not exist, it is created from the 
+    json state file (or from default values if the json state file cannot
+    be loaded). The block outlives the processes using it, until unlink is
+    called.
+    
+    Reads and writes are direct memory accesses, with no file system
+    involvement, and changes are immediately visible to other processes.
+    Writers exclude each other with a lock on a file named after the block
+    in the temporary directory.
+    """
+    PREFIX = 'microbit_'
+    __WAIT = 1
+    
+    def __init__(self, data):
+        self.__blocks = {}
+        super().__init__(data)
+        
+    def name(filename):
+        """Returns the name of the shared memory block for the named json 
+        state file.
+        """
+        path = os.path.abspath(filename).encode('utf-8')
+        return SharedMemoryBackend.PREFIX + hashlib.sha1(path).hexdigest()[:20]
+        
+    def __open(name, create=False):
+        from multiprocessing import resource_tracker, shared_memory
+        
+        try:
+            return shared_memory.SharedMemory(name, create, 
+                                        MappedFileBackend.SIZE, track=False)
+        except TypeError:
+            # before Python 3.13 blocks are always tracked and would be 
+            # unlinked by the resource tracker when this process exits
+            block = shared_memory.SharedMemory(name, create, 
+                                                MappedFileBackend.SIZE)
+            resource_tracker.unregister(block._name, 'shared_memory')
+            return block
+        
+    def map(self, filename):
+        name = SharedMemoryBackend.name(filename)
+        magic = len(MappedFileBackend.MAGIC)
+        
+        try:
+            block = SharedMemoryBackend.__open(name, True)
+            image = self.image(filename)
+            # write magic last so that attaching processes wait for the rest
+            block.buf[magic:len(image)] = image[magic:]
+            block.buf[:magic] = image[:magic]
+        except FileExistsError:
+            block = SharedMemoryBackend.__open(name)
+            deadline = time.monotonic() + SharedMemoryBackend.__WAIT
+            while bytes(block.buf[:magic]) != MappedFileBackend.MAGIC \
+                    and time.monotonic() < deadline:
+                time.sleep(0.001)
+                
+        self.__blocks[id(block.buf)] = block
+        return block.buf
+    
+    def unmap(self, buf):
+        self.__blocks.pop(id(buf)).close()
+        
+    def lock_path(self, filename):
+        """Returns the path of the file locked by writers of the shared 
+        memory block for the named json state file, in the temporary 
+        directory.
+        """
+        return os.path.join(tempfile.gettempdir(), 
+                            SharedMemoryBackend.name(filename) + '.lock')
+        
+    def unlink(self):
+        """Destroy the shared memory block for the current state file.
+        
+        Processes that are attached to the block can continue to use it.
+        """
+        for block in self.__blocks.values():
+            block.unlink()
+        
+
+class SqliteBackend(StateBackend):
+    """Stores state in an SQLite database in write-ahead logging (WAL) mode.
+    
+    The database is stored next to the json state file it corresponds to,
+    with the extension .sqlite. If the database does not exist, it is 
+    created from the json state file (or from default values if the json 
+    state file cannot be loaded).
+    
+    Every set, batch, press and reset is a single short transaction, so 
+    that concurrent processes never see partial changes, and press counters
+    are incremented atomically by the database. In WAL mode, readers do not
+    block writers or vice versa. state_file chaining works as it does for
+    json state files: loading opens the database for the next file in the 
+    chain, if it is not the current file.
+    """
+    EXTENSION = '.sqlite'
+    __STATE_FILE_KEY = 'state_file'
+    __TIMEOUT = 10
+    
+    def __init__(self, data):
+        """Open the database for the initial json state_file, creating the 
+        database if necessary.
+        
+        Raises OSError if the database cannot be created or opened.
+        """
+        self.__defaults = dict(data)
+        self.__writes = 0
+        self.filename = data[SqliteBackend.__STATE_FILE_KEY]
+        self.__db = self.__connect(self.filename)
+        
+    def path(filename):
+        """Returns the path of the database for the named json state file.
+        """
+        return os.path.splitext(filename)[0] + SqliteBackend.EXTENSION
+        
+    def __connect(self, filename):
+        data = dict(self.__defaults)
+        data[SqliteBackend.__STATE_FILE_KEY] = filename
+        
+        try:
+            with open(filename) as f:
+                data.update(json.load(f))
+        except:
+            pass
+        
+        try:
+            db = sqlite3.connect(SqliteBackend.path(filename), 
+                                    timeout=SqliteBackend.__TIMEOUT,
+                                    isolation_level=None, 
+                                    check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            with SqliteBackend.__transaction(db):
+                db.execute('CREATE TABLE IF NOT EXISTS state '
+                            '(key TEXT PRIMARY KEY, value)')
+                db.executemany('INSERT OR IGNORE INTO state VALUES (?, ?)',
+                                [(k, data[k]) for k in self.__defaults])
+        except sqlite3.Error as e:
+            raise OSError(e)
+        
+        return db
+    
+    @contextlib.contextmanager
+    def __transaction(db):
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+    
+    def get(self, key, default=0):
+        row = self.__db.execute('SELECT value FROM state WHERE key = ?', 
+                                    (key,)).fetchone()
+        return default if row is None else row[0]
+    
+    def set(self, key, value):
+        self.__db.execute('UPDATE state SET value = ? WHERE key = ?', 
+                            (value, key))
+        self.__writes = self.__writes + 1
+        
+    def batch(self, changes):
+        with SqliteBackend.__transaction(self.__db):
+            self.__db.executemany('UPDATE state SET value = ? WHERE key = ?',
+                                    [(v, k) for k, v in changes.items()])
+        self.__writes = self.__writes + 1
+        
+    def press(self, key, presses_key=None):
+        with SqliteBackend.__transaction(self.__db):
+            self.__db.execute('UPDATE state SET value = 1 WHERE key = ?', 
+                                (key,))
+            if presses_key is not None:
+                self.__db.execute('UPDATE state SET value = value + 1 '
+                                    'WHERE key = ?', (presses_key,))
+        self.__writes = self.__writes + 1
+        
+    def reset(self, values):
+        with SqliteBackend.__transaction(self.__db):
+            self.__db.execute('UPDATE state SET value = 0 WHERE key != ?', 
+                                (SqliteBackend.__STATE_FILE_KEY,))
+            self.__db.executemany('UPDATE state SET value = ? WHERE key = ?',
+                                    [(v, k) for k, v in values.items()])
+        self.__writes = self.__writes + 1
+        
+    def version(self):
+        """Returns a value that changes whenever this or another process 
+        commits a change.
+        """
+        data_version = self.__db.execute('PRAGMA data_version').fetchone()[0]
+        return (self.filename, data_version, self.__writes)
+    
+    def snapshot(self):
+        return dict(self.__db.execute('SELECT key, value FROM state'))
+    
+    def load(self):
+        filename = self.get(SqliteBackend.__STATE_FILE_KEY)
+        if filename != self.filename:
+            try:
+                db = self.__connect(filename)
+            except OSError:
+                return
+            
+            self.__db.close()
+            self.__db = db
+            self.filename = filename
+            
+
+class JournalBackend(StateBackend):
+    """Stores state in an append-only journal of changes.
+    
+    The journal is stored next to the json state file it corresponds to, 
+    with the extension .journal. Each line of the journal is a compact json
+    record [seq, key, value] of a change, or [seq, null, state] for a
+    snapshot of the whole state. If the journal does not exist, it is 
+    created with a snapshot from the json state file (or from default 
+    values if the json state file cannot be loaded).
+    
+    Every change is appended to the journal, rather than the whole state 
+    being rewritten, and loading replays only the records appended since
+    the last load. When the records following the latest snapshot grow 
+    beyond journal_max_size bytes, the journal is compacted: it is replaced
+    by a journal holding a single snapshot. The replacement is atomic, so 
+    other processes never see a partly written journal, and processes that
+    have the old journal open reopen the new one.
+    
+    Where supported, appends and compaction are serialised between 
+    processes by locking the journal, so that press counters are 
+    incremented atomically. A record left incomplete by a writer that 
+    stopped part way through is removed by the next append, and lines that
+    are not valid records are skipped when loading. state_file chaining works as it does for json 
+    state files: loading opens the journal for the next file in the chain,
+    if it is not the current file.
+    """
+    EXTENSION = '.journal'
+    __STATE_FILE_KEY = 'state_file'
+    
+    def __init__(self, data, journal_max_size=journal_max_size):
+        self.__defaults = dict(data)
+        self.__max_size = journal_max_size
+        self.__file = None
+        self.__stats = { 'appends': 0, 'replayed': 0, 'compactions': 0,
+                            'skipped': 0 }
+        self.__open(data[JournalBackend.__STATE_FILE_KEY])
+        
+    def path(filename):
+        """Returns the path of the journal for the named json state file.
+        """
+        return os.path.splitext(filename)[0] + JournalBackend.EXTENSION
+    
+    def __record(seq, key, value):
+        return (json.dumps([seq, key, value], separators=(',', ':'), 
+                            ensure_ascii=False) + '\n').encode('utf-8')
+        
+    def __create(self, path, filename):
+        data = dict(self.__defaults)
+        data[JournalBackend.__STATE_FILE_KEY] = filename
+        
+        try:
+            with open(filename) as f:
+                data.update(json.load(f))
+        except:
+            pass
+        
+        # create under a temporary name and link into place so that a 
+        # concurrent process never opens a partly written journal
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(JournalBackend.__record(0, None, data))
+            
+        try:
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+        
+    def __open(self, filename):
+        path = JournalBackend.path(filename)
+        
+        if not os.path.exists(path):
+            self.__create(path, filename)
+            
+        f = open(path, 'a+b', buffering=0)
+        
+        if self.__file is not None:
+            self.__file.close()
+            
+        self.filename = filename
+        self.__path = path
+        self.__file = f
+        self.__offset = 0
+        self.__snapshot_end = 0
+        self.__seq = 0
+        self.data = {}
+        self.__tail()
+        
+    def __replaced(self):
+        try:
+            return os.stat(self.__path).st_ino \
+                    != os.fstat(self.__file.fileno()).st_ino
+        except OSError:
+            return False
+        
+    def __tail(self):
+        # replay complete records appended since the last replay
+        if self.__replaced():
+            self.__open(self.filename)
+            return
+        
+        self.__file.seek(self.__offset)
+        chunk = self.__file.read()
+        
+        for line in chunk.splitlines(True):
+            if not line.endswith(b'\n'):
+                break
+            
+            self.__offset = self.__offset + len(line)
+            try:
+                seq, key, value = json.loads(line.decode('utf-8'))
+            except (ValueError, TypeError):
+                # e.g. an incomplete record followed by another record
+                self.__stats['skipped'] += 1
+                continue
+            
+            if key is None:
+                self.data = dict(value)
+                self.__snapshot_end = self.__offset
+            else:
+                self.data[key] = value
+            self.__seq = seq
+            self.__stats['replayed'] += 1
+        
+    @contextlib.contextmanager
+    def __locked(self):
+        # lock the current journal, catching up with any changes 
+        while True:
+            if fcntl:
+                fcntl.flock(self.__file.fileno(), fcntl.LOCK_EX)
+            if not self.__replaced():
+                break
+            self.__tail()
+        
+        try:
+            self.__tail()
+            yield
+        finally:
+            if fcntl and not self.__file.closed:
+                fcntl.flock(self.__file.fileno(), fcntl.LOCK_UN)
+                
+    def __append(self, changes):
+        # must be called with the journal locked (and so replayed), so any
+        # bytes after the replayed records are an incomplete record left by 
+        # a writer that stopped part way through
+        if fcntl and os.fstat(self.__file.fileno()).st_size > self.__offset:
+            self.__file.truncate(self.__offset)
+            self.__stats['skipped'] += 1
+            
+        records = []
+        for key, value in changes.items():
+            self.__seq = self.__seq + 1
+            records.append(JournalBackend.__record(self.__seq, key, value))
+            self.data[key] = value
+            
+        buf = b''.join(records)
+        self.__file.write(buf)
+        self.__offset = self.__offset + len(buf)
+        self.__stats['appends'] += 1
+        
+        if self.__max_size is not None \
+                and self.__offset - self.__snapshot_end > self.__max_size:
+            self.__compact()
+            
+    def __compact(self):
+        # must be called with the journal locked
+        tmp = '{0}.{1}.tmp'.format(self.__path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(JournalBackend.__record(self.__seq, None, self.data))
+        os.replace(tmp, self.__path)
+        self.__stats['compactions'] += 1
+    
+    def get(self, key, default=0):
+        return self.data.get(key, default)
+    
+    def set(self, key, value):
+        self.batch({ key:value })
+        
+    def batch(self, changes):
+        with self.__locked():
+            self.__append(changes)
+            
+    def press(self, key, presses_key=None):
+        with self.__locked():
+            changes = { key:1 }
+            if presses_key is not None:
+                changes[presses_key] = self.data.get(presses_key, 0) + 1
+            self.__append(changes)
+            
+    def reset(self, values):
+        with self.__locked():
+            changes = { k:values.get(k, 0) for k in self.data.keys() 
+                        if k != JournalBackend.__STATE_FILE_KEY }
+            self.__append(changes)
+            
+    def version(self):
+        return (self.filename, self.__seq)
+    
+    def snapshot(self):
+        return dict(self.data)
+    
+    def stats(self):
+        """Returns a dictionary of journal counters.
+        
+        appends is the number of appends to the journal by this process, 
+        replayed is the number of journal records replayed, compactions is
+        the number of times this process has compacted the journal and 
+        skipped is the number of incomplete or invalid records skipped or 
+        removed by this process.
+        """
+        return dict(self.__stats)
+    
+    def load(self):
+        self.__tail()
+        
+        filename = self.data.get(JournalBackend.__STATE_FILE_KEY, 
+                                    self.filename)
+        if filename != self.filename:
+            try:
+                self.__open(filename)
+            except OSError:
+                pass
+            
+    def dump(self):
+        """Compact the journal.
+        """
+        with self.__locked():
+            self.__compact()
+            
 
+""" The built-in state backends, by name """
+STATE_BACKENDS = {
+    'memory': MemoryBackend,
+    'journal': JournalBackend,
+    'json': JsonFileBackend,
+    'mmap': MappedFileBackend,
+    'shm': SharedMemoryBackend,
+    'sqlite': SqliteBackend,
+    }
 
-__all__ = [ 'panic', 'reset', 'running_time', 'sleep', 
-            'Accelerometer', 'accelerometer',
-            'compass',
-            'button_a', 'button_b',
-            'display',
-            'Image',
-            'i2c',
-            'pin0', 'pin1', 'pin2', 'pin3', 'pin4', 'pin5', 'pin6', 'pin7',
-            'pin8', 'pin9', 'pin10', 'pin11', 'pin12', 'pin13', 'pin14',
-            'pin15', 'pin16', 'pin19', 'pin20',
-            'uart', 
-            'state',
-        ]
+
+class Clock:
+    """Controls how time passes during emulation.
+    
+    This is for emulation purposes - Clock is not part of the microbit API.
+    Each State has a clock that is used by sleep and running_time. In 'real'
+    mode (the default), sleep blocks for the given number of milliseconds 
+    and each call to running_time adds a random increment of up to 100ms to
+    the running time, to emulate the time taken by the program between 
+    calls. In 'virtual' mode, sleep only advances the running time and 
+    never blocks, and each call to running_time adds 1ms, so that programs
+    run as fast as possible and repeatably, with consistent timing.
+    
+    In 'real' mode, the scale is the speed of the microbit relative to real
+    time: sleep(ms) blocks for ms/scale milliseconds, so a scale of 10 
+    runs 10 times faster than real time and a scale of 0.5 runs at half
+    speed. The running time is still in microbit milliseconds. Each sleep
+    blocks until an absolute deadline (the time of the first sleep plus the
+    scaled total of all sleeps), so that the time taken by the program 
+    between sleeps and errors in individual sleeps do not accumulate. If 
+    sleep falls more than 100ms behind its deadline (e.g. because the 
+    program did not sleep for a while), deadlines start again from the
+    current time.
+    
+    If monotonic is True in 'real' mode, the running time is the real time
+    (multiplied by the scale) since the clock was created or restarted, 
+    rather than the total of sleeps and increments.
+    
+    'scheduled' mode is 'virtual' mode with idle loop detection. A sleep 
+    by the program is idle if the program has not read the running time 
+    since its previous sleep and the sleep is at the same place in the 
+    program with the same state, display image and program variables as 
+    the previous sleep. After idle_sleeps consecutive idle sleeps, the 
+    program cannot observe any change before the next state change 
+    scheduled with State.schedule, so sleep jumps the running time to that
+    change (in multiples of the time slept). If there is no scheduled 
+    change, sleep raises EmulationStopped.
+    """
+    MODES = ('real', 'virtual', 'scheduled')
+    __MAX_LAG_NS = 100000000
+    
+    def __init__(self, mode=time_mode, scale=time_scale, 
+                    monotonic=monotonic_running_time, idle_sleeps=idle_sleeps):
+        if mode not in Clock.MODES:
+            raise ValueError('unknown time mode ' + str(mode))
+        if not scale > 0:
+            raise ValueError('time scale must be positive')
+        
+        self.mode = mode
+        self.scale = scale
+        self.monotonic = monotonic and mode == 'real'
+        self.idle_sleeps = idle_sleeps
+        self.__start = time.monotonic_ns()
+        self.__origin = None
+        self.__slept = 0
+        self.__stats = { 'sleeps': 0, 'lagged': 0, 'max_overshoot_us': 0,
+                            'overshoot_us': {}, 'skips': 0, 'skipped_ms': 0 }
+        
+    def is_virtual(self):
+        """Returns True if the clock is in virtual (or scheduled) mode.
+        """
+        return self.mode != 'real'
+    
+    def is_scheduled(self):
+        """Returns True if the clock is in scheduled mode.
+        """
+        return self.mode == 'scheduled'
+    
+    def skip(self, ms):
+        """Records that ms milliseconds of idle time were skipped.
+        """
+        self.__stats['skips'] += 1
+        self.__stats['skipped_ms'] += ms
+    
+    def restart(self):
+        """Restarts the monotonic running time from 0.
+        """
+        self.__start = time.monotonic_ns()
+        
+    def elapsed(self):
+        """Returns the number of microbit milliseconds since the clock was
+        created or restarted.
+        """
+        return int((time.monotonic_ns() - self.__start) * self.scale 
+                    / 1000000)
+        
+    def sleep(self, ms):
+        """Blocks until the deadline of this sleep of the given number of 
+        milliseconds (divided by the scale), unless the clock is virtual.
+        """
+        if ms <= 0 or self.is_virtual():
+            return
+        
+        deadline, delay = self.__deadline(ms)
+        if delay > 0:
+            time.sleep(delay)
+        self.__woke(deadline)
+        
+    async def sleep_async(self, ms):
+        """Awaits the deadline of this sleep of the given number of 
+        milliseconds (divided by the scale), without blocking other tasks.
+        
+        If the clock is virtual, only yields to other tasks.
+        """
+        if ms <= 0 or self.is_virtual():
+            await asyncio.sleep(0)
+            return
+        
+        deadline, delay = self.__deadline(ms)
+        await asyncio.sleep(max(0, delay))
+        self.__woke(deadline)
+        
+    def __deadline(self, ms):
+        # the deadline of a sleep and the seconds until it
+        now = time.monotonic_ns()
+        if self.__origin is None:
+            self.__origin = now
+        
+        self.__slept = self.__slept + ms
+        deadline = self.__origin + round(self.__slept * 1000000 / self.scale)
+        
+        return deadline, (deadline - now) / 1e9
+    
+    def __woke(self, deadline):
+        now = time.monotonic_ns()
+        self.__record(now - deadline)
+        
+        if now - deadline > Clock.__MAX_LAG_NS:
+            self.__stats['lagged'] += 1
+            self.__origin = now
+            self.__slept = 0
+            
+    def __record(self, overshoot_ns):
+        # histogram of overshoot with power of 2 microsecond bounds
+        us = max(0, overshoot_ns // 1000)
+        bound = 1 << (us - 1).bit_length() if us > 0 else 0
+        histogram = self.__stats['overshoot_us']
+        histogram[bound] = histogram.get(bound, 0) + 1
+        self.__stats['sleeps'] += 1
+        self.__stats['max_overshoot_us'] = max(us, 
+                                            self.__stats['max_overshoot_us'])
+        
+    def stats(self):
+        """Returns a dictionary of sleep timing counters.
+        
+        sleeps is the number of blocking sleeps and lagged is the number of
+        sleeps that were too far behind their deadlines to catch up. 
+        overshoot_us is a histogram of the time by which sleeps overshot 
+        their deadlines: it maps a power of 2 number of microseconds to the
+        number of sleeps that overshot by at most that time but more than 
+        half of it (0 is for sleeps that were on time). max_overshoot_us is 
+        the largest overshoot. skips and skipped_ms are the number of idle
+        sleeps that were extended in scheduled mode and the total time they
+        skipped.
+        """
+        stats = dict(self.__stats)
+        stats['overshoot_us'] = dict(sorted(stats['overshoot_us'].items()))
+        return stats
+        
+
+class Scenario:
+    """A timeline of input events, each of which sets a state key to a value
+    at a running time in milliseconds.
+    
+    This is for emulation purposes - Scenario is not part of the microbit 
+    API. The source of events is either the name of a file with one json 
+    [time_ms, key, value] event per line or an iterable of (time_ms, key, 
+    value) tuples. Events must be in time order. If a validate function is 
+    given, it is called with the key and value of each event and returns 
+    the value to use (or raises ValueError).
+    
+    Unless stream is True, all events are read when the scenario is created
+    and indexed by key and time. If stream is True, events are only read 
+    when the running time reaches them and only the latest event for each 
+    key is kept, so that very long scenarios can be used. A streamed 
+    scenario is read again from the start if the running time goes back 
+    (e.g. on power off), so an iterable source must be re-iterable.
+    """
+    def __init__(self, source, stream=False, validate=None):
+        self.stream = stream
+        self.__source = source
+        self.__validate = validate
+        self.__rewind()
+        
+        if not stream:
+            self.__read(None)
+            self.__all = sorted(t for times in self.__times.values() 
+                                for t in times)
+            
+    def __rewind(self):
+        self.__events = iter(self.__lines()) \
+                        if isinstance(self.__source, str) \
+                        else iter(self.__source)
+        self.__next = None
+        self.__last = None
+        self.__position = -1
+        self.__times = {}
+        self.__values = {}
+        
+    def __lines(self):
+        # events from a scenario file
+        with open(self.__source) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        
+    def __peek(self):
+        # the next event, or None if there are no more events
+        if self.__next is None:
+            try:
+                event = next(self.__events)
+            except StopIteration:
+                return None
+            
+            try:
+                time_ms, key, value = event
+            except (TypeError, ValueError):
+                raise ValueError('invalid scenario event {0!r}'.format(event))
+            if isinstance(time_ms, bool) \
+                    or not isinstance(time_ms, (int, float)) \
+                    or not isinstance(key, str):
+                raise ValueError('invalid scenario event {0!r}'.format(event))
+            
+            if self.__last is not None and time_ms < self.__last:
+                raise ValueError('scenario event at {0}ms is out of order'
+                                    .format(time_ms))
+            self.__last = time_ms
+            
+            key = key.lower()
+            if self.__validate is not None:
+                try:
+                    value = self.__validate(key, value)
+                except TypeError:
+                    raise ValueError('invalid scenario event {0!r}'
+                                        .format(event))
+                
+            self.__next = (time_ms, key, value)
+        return self.__next
+            
+    def __read(self, until):
+        # read events up to and including time until (or all events)
+        while True:
+            event = self.__peek()
+            if event is None or (until is not None and event[0] > until):
+                break
+            
+            self.__next = None
+            time_ms, key, value = event
+            if self.stream:
+                self.__times[key] = [time_ms]
+                self.__values[key] = [value]
+            else:
+                self.__times.setdefault(key, []).append(time_ms)
+                self.__values.setdefault(key, []).append(value)
+        
+        if until is not None:
+            self.__position = until
+            
+    def __seek(self, time_ms):
+        if self.stream:
+            if time_ms < self.__position:
+                self.__rewind()
+            self.__read(time_ms)
+            
+    def value_at(self, key, time_ms):
+        """Returns a (time_ms, value) tuple for the latest event for the key
+        at or before the given time, or None if there is no such event.
+        """
+        self.__seek(time_ms)
+        times = self.__times.get(key)
+        if times:
+            i = bisect.bisect_right(times, time_ms)
+            if i > 0:
+                return (times[i - 1], self.__values[key][i - 1])
+        return None
+    
+    def next_time(self, time_ms):
+        """Returns the time of the first event after the given time, or None
+        if there are no more events.
+        """
+        if self.stream:
+            self.__seek(time_ms)
+            event = self.__peek()
+            return event[0] if event is not None else None
+        
+        i = bisect.bisect_right(self.__all, time_ms)
+        return self.__all[i] if i < len(self.__all) else None
+        
+
+class EmulationStopped(BaseException):
+    """Raised by sleep in 'scheduled' time mode when the program is idle and
+    there are no scheduled state changes, so nothing further can happen.
+    
+    This is for emulation purposes - it is not part of the microbit API.
+    It is derived from BaseException so that it is not caught by programs
+    that catch Exception.
+    """
+    pass
+
+
+class BudgetExhausted(EmulationStopped):
+    """Raised when a program has used its run budget (see State.budget).
+    
+    This is for emulation purposes - it is not part of the microbit API.
+    progress is a dictionary of how far the program got (see 
+    State.progress).
+    """
+    def __init__(self, message, progress):
+        super().__init__(message)
+        self.progress = progress
 
 
-""" State ---------------------------------------------------------------- """
-""" This is for the emulation not part of the microbit module ------------ """
 class State:
     """Represents the state of the microbit buttons and pins.
     
     This is for emulation purposes - State is not part of the microbit API.
-    There is a single state object. It is used to manage state during 
+    There is a state object for each Device. It is used to manage state during 
     emulation. It can also be used to programmatically manipulate microbit
     state in a test program.
+
+    State values are stored by a StateBackend. The backend is either a 
+    StateBackend subclass or the name of one of the STATE_BACKENDS: 'json' 
+    (the default) stores state in json state files, 'memory' stores state in
+    memory only, 'mmap' stores state in memory-mapped binary files and 
+    'shm' in named shared memory blocks (both of which can be shared by 
+    processes without file parsing), 'sqlite' stores state in SQLite 
+    databases that can be changed transactionally by concurrent processes
+    and 'journal' stores state in append-only journals of changes.
+    Options are passed to the backend (e.g. write_behind and 
+    write_behind_latency for 'json'). If the backend cannot be initialised
+    (e.g. because of a file error), a RuntimeWarning is issued and the 
+    'json' backend is used with its default options.
+    
+    Subscribers are notified of state changes on flush and on load (see the
+    subscribe method).
+    
+    The clock controls how time passes on sleep (see the Clock class). If 
+    no clock is given, a Clock in the time_mode setting is used. State 
+    changes can be scheduled for a running time (see the schedule method)
+    and a scenario of input events can be played (see the play method). A
+    run budget limits how far a program can run (see the budget method).
     """
     __VALUE_MIN = 0
     __VALUE_MAX = 1023
@@ -87,9 +1739,11 @@ class State:
                                 'accelerometer_z']
     __PRESSES_KEYS = ['button_a_presses', 'button_b_presses']
     
-    def __init__(self):
+    def __init__(self, state_file=state_file, state_backend=state_backend,
+                    clock=None, **options):
         self.__running_time = 0 # not part of persistent state
-        self.__data = {
+        self.clock = clock if clock is not None else Clock()
+        data = {
             "accelerometer_x": 0, 
             "accelerometer_y": 0, 
             "accelerometer_z": 0, 
@@ -119,15 +1773,61 @@ class State:
             "pin20": 0,
             "power": 1
         }
+        self.__keys = frozenset(data.keys())
+        
+        if isinstance(state_backend, str):
+            if state_backend not in STATE_BACKENDS:
+                raise ValueError('unknown state backend ' + state_backend)
+            state_backend = STATE_BACKENDS[state_backend]
+            
+        try:
+            self.__backend = state_backend(data, **options)
+        except (OSError, ValueError) as e:
+            # the options are for the requested backend, so are not passed on
+            warnings.warn('cannot use {0} state backend ({1}), using json '
+                            'state files instead'.format(
+                                state_backend.__name__, e), RuntimeWarning)
+            self.__backend = JsonFileBackend(data)
+            
+        self.__subscribers = []
+        self.__changes = []
+        self.__notified = None
+        self.__transaction = None
+        self.__events = []
+        self.__event_count = 0
+        self.__observation = None
+        self.__idle_sleeps = 0
+        self.__time_observed = False
+        self.__set_times = {}
+        self.scenario = None
+        self.__display = None
+        self.__budget = {}
+        self.__progress = { 'start': 0, 'sleeps': 0, 'frames': 0 }
+        
+        if scenario_file:
+            self.play(scenario_file, scenario_stream)
 
-        self.load()
-
+    def __get_data(self):
+        # the state dictionary of dictionary based backends
+        if isinstance(self.__backend, (MemoryBackend, JsonFileBackend)):
+            return self.__backend.data
+        return self.__backend.snapshot()
+    
+    __data = property(__get_data)
+    
     def __get_runtime(self):
+        self.__time_observed = True
+        return self.__now()
+    
+    def __now(self):
+        if self.clock.monotonic:
+            return self.clock.elapsed()
+        
         return self.__running_time
         
     def __incr_runtime(self, ms, randomise = False):
-        if ms >= 0:
-            if randomise:
+        if ms >= 0 and not self.clock.monotonic:
+            if randomise and not self.clock.is_virtual():
                 ms = random.randint(ms, State.__RUNTIME_MAX_INCR)
             
             self.__running_time = self.__running_time + ms
@@ -137,62 +1837,373 @@ class State:
                 or (value >= State.__VALUE_MIN \
                     and (key in State.__PRESSES_KEYS \
                             or value <= State.__VALUE_MAX))
+    
+    def __validated(self, changes):
+        # changes with lower case known keys and checked values
+        validated = {}
+        for key, value in changes.items():
+            key = key.lower()
+            if key in self.__keys:
+                if key != State.__STATE_FILE_KEY:
+                    if not self.__valid_value(key, value):
+                        raise ValueError(
+                            'invalid value {0} for key {1}'.format(value, key))
+                                
+                    value = int(value)
+                    
+                validated[key] = value
+        return validated
+    
+    def __commit(self, changes):
+        # changes is a validated dictionary of changes
+        if self.__transaction is not None:
+            self.__transaction.update(changes)
+        elif changes:
+            self.__backend.batch(changes)
+            
+            if self.scenario is not None:
+                now = self.__now()
+                self.__set_times.update((k, now) for k in changes)
+            
+            if self.__subscribers:
+                self.__changes.extend(changes.items())
         
     def get(self, key):
         """Returns the state associated with the named key. 
         
-        The key string can be one of:
-        accelerometer_x, accelerometer_z, accelerometer_y
-        buton_a, button_a_presses, button_b, button_b_presses
-        state_file,
-        pin0 to pin16, pin19, pin20
-        power
+        The key string can be one of:
+        accelerometer_x, accelerometer_z, accelerometer_y
+        buton_a, button_a_presses, button_b, button_b_presses
+        state_file,
+        pin0 to pin16, pin19, pin20
+        power
+        
+        If there is no state associated with the key, 0 is returned
+        (note, 0 may be a valid value for the given key)
+
+        Within a transaction, values set in the transaction are returned.
+
+        This method is usually used through one of the corresponding, 
+        higher-level microbit objects (e.g. accelerometer, button, etc.).        
+        """
+        key = key.lower()
+        if self.__transaction is not None and key in self.__transaction:
+            return self.__transaction[key]
+        
+        if self.scenario is not None:
+            event = self.scenario.value_at(key, self.__now())
+            if event is not None and event[0] > self.__set_times.get(key, -1):
+                return event[1]
+        
+        return self.__backend.get(key, State.__VALUE_MIN)
+        
+    def set(self, key, value):
+        """Sets the state associated with the named key to the given value.
+        
+        The key string can be one of:
+        accelerometer_x, accelerometer_z, accelerometer_y
+        buton_a, button_a_presses, button_b, button_b_presses
+        state_file,
+        pin0 to pin16, pin19, pin20
+        power
+        
+        This method has no effect if the key is unknown.   
+
+        The value is checked for validity: state_file can have any value, 
+        accelerometer values can be any integer, all other values must be
+        positive and all but the button_presses values must be less than 
+        or equal to 1023.
+ 
+        This method is usually used through one of the corresponding, 
+        higher-level microbit objects (e.g. accelerometer, button, etc.). 
+
+        It can also be used to update state in a test program.    
+        """
+        self.update({ key:value })
+        
+    def update(self, changes):
+        """Sets the state associated with each key in the changes dictionary
+        to the given value.
+        
+        Keys and values are as for set. Unknown keys are ignored. All values 
+        are checked before any state is changed, so that if a ValueError is 
+        raised for an invalid value no state is changed. The changes are 
+        made as a single batch (e.g. with a single load and dump of the
+        state file).
+        """
+        self.__commit(self.__validated(changes))
+        
+    @contextlib.contextmanager
+    def transaction(self):
+        """Returns a context manager that holds back state changes made 
+        within the with statement and makes them as a single batch (as for 
+        update) at the end of the statement.
+        
+        If the statement raises an exception (e.g. a ValueError for an 
+        invalid value), no state is changed. Nested transactions are part 
+        of the outermost transaction.
+        """
+        if self.__transaction is not None:
+            yield self
+            return
+        
+        self.__transaction = {}
+        try:
+            yield self
+            changes = self.__transaction
+        finally:
+            self.__transaction = None
+        
+        self.__commit(changes)
+
+    def schedule(self, time_ms, changes):
+        """Schedule the changes (a dictionary of keys and values, as for 
+        update) to be made by the first sleep that ends at or after the 
+        given running time in milliseconds.
+        
+        Values are checked when the changes are scheduled.
+        """
+        heapq.heappush(self.__events, 
+                        (time_ms, self.__event_count, self.__validated(changes)))
+        self.__event_count = self.__event_count + 1
+        
+    def play(self, source, stream=False):
+        """Play a scenario of input events from the source (see the Scenario
+        class), replacing any scenario already playing.
+        
+        While a scenario is playing, get (and snapshot) returns the value of
+        the latest event for the key at or before the current running time,
+        unless the key has been set since that time. Subscribers are 
+        notified of the changes made by events, on load. Events are checked
+        as they are read. If source is None, the scenario is stopped.
+        """
+        self.__set_times = {}
+        self.scenario = None
+        if source is not None:
+            self.scenario = Scenario(source, stream, self.__validated_value)
+            
+    def __validated_value(self, key, value):
+        if key not in self.__keys:
+            raise ValueError('unknown key ' + str(key))
+        return self.__validated({ key:value })[key]
+        
+    def budget(self, ms=None, sleeps=None, frames=None):
+        """Set a run budget and restart progress (see the progress method)
+        from the current running time.
+        
+        The budget is exhausted when the running time has advanced by ms 
+        milliseconds, when sleep has been called the given number of times
+        or when the display has been updated the given number of frames, 
+        whichever is first. The sleep or display update that exhausts the 
+        budget raises BudgetExhausted. A limit of None is unlimited.
+        """
+        self.__budget = { k:v for k, v in 
+                            [('ms', ms), ('sleeps', sleeps), ('frames', frames)]
+                            if v is not None }
+        self.__progress = { 'start': self.__now(), 'sleeps': 0, 'frames': 0 }
+        
+    def progress(self):
+        """Returns a dictionary of the progress of the program since the 
+        budget was last set (or since the state was created): running_time
+        is the running time in milliseconds, sleeps is the number of calls
+        to sleep and frames is the number of display updates.
+        """
+        return { 'running_time': self.__now() - self.__progress['start'],
+                    'sleeps': self.__progress['sleeps'],
+                    'frames': self.__progress['frames'] }
+    
+    def __spend(self, kind):
+        # count a sleep or frame against the budget
+        self.__progress[kind] += 1
+        
+        if not self.__budget:
+            return
+        
+        progress = self.progress()
+        for k, limit in self.__budget.items():
+            if progress['running_time' if k == 'ms' else k] >= limit:
+                raise BudgetExhausted('run budget of {0} {1} exhausted'
+                                        .format(limit, k), progress)
+        
+    def __run_events(self):
+        # make the scheduled changes that are due
+        now = self.__now()
+        while self.__events and self.__events[0][0] <= now:
+            self.update(heapq.heappop(self.__events)[2])
+            
+    def sleep(self, ms):
+        """Sleep for the given number of milliseconds with this state's 
+        clock, as the sleep function does for the state of the current 
+        device (flushing, loading and running scheduled changes and 
+        counting the sleep against this state's budget).
+        
+        This is for sleeps by the emulation (e.g. press_and_release and the
+        display of a device), which are never idle.
+        """
+        self.__sleep(ms, None)
+        
+    async def sleep_async(self, ms):
+        """Sleep as the sleep method does, awaiting the sleep (see the 
+        sleep_async function).
+        """
+        await self.__sleep_async(ms, None)
+        
+    def __sleep(self, ms, caller):
+        ms = self.__sleep_start(ms, caller)
+        self.clock.sleep(ms)
+        self.__sleep_end(ms)
+        
+    async def __sleep_async(self, ms, caller):
+        ms = self.__sleep_start(ms, caller)
+        await self.__wait_async(ms)
+        self.__sleep_end(ms)
+        
+    async def __wait_async(self, ms):
+        # awaits a sleep, in running time order with the other programs run
+        # by run_program_async if the clock is virtual
+        timeline = _timeline.get()
+        if timeline is not None and self.clock.is_virtual():
+            await timeline.wait(self.__now() + ms)
+        else:
+            await self.clock.sleep_async(ms)
+            
+    def __sleep_start(self, ms, caller):
+        # flush before a sleep by the caller frame (None for sleeps by the
+        # emulation, which are never idle) and return the ms to sleep
+        self.flush()
+        if self.__display is not None:
+            self.__display.sink.flush()
+        
+        if self.clock.is_scheduled() and caller is not None \
+                and caller.f_globals is not globals():
+            image = repr(self.__display.image) \
+                        if self.__display is not None else None
+            ms = self.__skip(ms, (caller.f_code, caller.f_lineno, image,
+                                    _values_digest(caller)))
+        return ms
+    
+    def __sleep_end(self, ms):
+        # update the running time and state after a sleep
+        if ms > 0:
+            self.__incr_runtime(ms)
+        
+        self.load()
+        self.__run_events()
+        self.__spend('sleeps')
+        
+    def __skip(self, ms, observation):
+        # the time for the program to sleep, which skips to the next 
+        # scheduled change if the program is idle
+        observation = (observation, self.snapshot())
+        if observation == self.__observation and not self.__time_observed:
+            self.__idle_sleeps = self.__idle_sleeps + 1
+        else:
+            self.__idle_sleeps = 0
+        self.__observation = observation
+        self.__time_observed = False
+        
+        if self.__idle_sleeps < self.clock.idle_sleeps:
+            return ms
+        
+        times = [self.__events[0][0]] if self.__events else []
+        if self.scenario is not None:
+            times.append(self.scenario.next_time(self.__running_time))
+        times = [t for t in times if t is not None]
         
-        If there is no state associated with the key, 0 is returned
-        (note, 0 may be a valid value for the given key)
+        if not times:
+            raise EmulationStopped(
+                    'idle with no scheduled changes at running time {0}ms'
+                    .format(self.__running_time))
+            
+        wait = min(times) - self.__running_time
+        if ms > 0 and wait > ms:
+            skip = ms * -(-wait // ms)
+            self.clock.skip(skip - ms)
+            return skip
+        return ms
 
-        This method is usually used through one of the corresponding, 
-        higher-level microbit objects (e.g. accelerometer, button, etc.).        
+    def flush(self):
+        """Make state changes held back by the backend (e.g. in write-behind
+        mode) visible to other processes.
         """
-        return self.__data.get(key.lower(), State.__VALUE_MIN)
+        self.__backend.flush()
+        self.__notify()
+
+    def subscribe(self, keys=None, callback=None):
+        """Subscribe to changes to the named keys (or to all keys if keys is
+        None).
         
-    def set(self, key, value):
-        """Sets the state associated with the named key to the given value.
+        Changes are delivered in batches, on flush (for changes made through 
+        this state object) and on load (for changes made by other processes).
+        A batch is a list of (key, value) pairs in the order in which changes
+        were made. Changes made through this state object are all included,
+        so a key that is set to 1 and back to 0 between notifications 
+        appears twice. Changes made by other processes are those that differ
+        from the values seen at the previous notification.
         
-        The key string can be one of:
-        accelerometer_x, accelerometer_z, accelerometer_y
-        buton_a, button_a_presses, button_b, button_b_presses
-        state_file,
-        pin0 to pin16, pin19, pin20
-        power
+        If a callback is given, it is called with each batch and is 
+        returned. Otherwise, a queue.Queue is returned and each batch is put
+        on the queue. Either can be passed to unsubscribe.
         
-        This method has no effect if the key is unknown.   
-
-        The value is checked for validity: state_file can have any value, 
-        accelerometer values can be any integer, all other values must be
-        positive and all but the button_presses values must be less than 
-        or equal to 1023.
- 
-        This method is usually used through one of the corresponding, 
-        higher-level microbit objects (e.g. accelerometer, button, etc.). 
-
-        It can also be used to update state in a test program.    
+        A ValueError is raised if a key is unknown.
+        """
+        if isinstance(keys, str):
+            keys = [keys]
         
+        if keys is not None:
+            keys = frozenset(k.lower() for k in keys)
+            unknown = keys - self.__keys
+            if unknown:
+                raise ValueError('unknown keys ' + ', '.join(sorted(unknown)))
+        
+        subscriber = callback if callback is not None else queue.Queue()
+        deliver = callback if callback is not None else subscriber.put
+        
+        if not self.__subscribers:
+            self.__changes = []
+            self.__notified = self.snapshot()
+        
+        self.__subscribers.append((subscriber, keys, deliver))
+        
+        return subscriber
+    
+    def unsubscribe(self, subscriber):
+        """Stop notifying the given subscriber (a callback or queue returned
+        by subscribe) of changes.
         """
-        key = key.lower()
-        if key in self.__data:
-            self.load()
-
-            if key != State.__STATE_FILE_KEY:
-                if not self.__valid_value(key, value):
-                    raise ValueError(
-                            'invalid value {0} for key {1}'.format(value, key))
-                            
-                value = int(value)
-
-            self.__data[key] = value
+        self.__subscribers = [s for s in self.__subscribers 
+                                if s[0] != subscriber]
+    
+    def __notify(self):
+        if not self.__subscribers:
+            return
+        
+        changes = self.__changes
+        self.__changes = []
+        notified = self.__notified
+        self.__notified = self.snapshot()
+        
+        for k, v in changes:
+            notified[k] = v
+            
+        for k in sorted(self.__notified.keys()):
+            if notified.get(k) != self.__notified[k]:
+                changes.append((k, self.__notified[k]))
+                
+        if not changes:
+            return
+        
+        for subscriber, keys, deliver in list(self.__subscribers):
+            batch = changes if keys is None \
+                        else [c for c in changes if c[0] in keys]
+            if batch:
+                deliver(batch)
 
-            self.dump()
+    def stats(self):
+        """Returns a dictionary of backend counters (see the backend class
+        stats method).
+        """
+        return self.__backend.stats()
 
     def press(self, input):
         """Emulates pressing down on a button. 
@@ -203,10 +2214,32 @@ class State:
         For a button press, the input can be either button_a or button_b. 
         If the input is another valid state key, this method will set the 
         associated value to 1.
+        
+        Within a transaction, the press is part of the transaction.
         """
+        input = input.lower()
         presses = input + '_presses'
-        self.set(input, 1)
-        self.set(presses, self.get(presses) + 1)
+        if input in self.__keys:
+            if presses not in self.__keys:
+                presses = None
+                
+            if self.__transaction is not None:
+                changes = { input:1 }
+                if presses is not None:
+                    changes[presses] = self.get(presses) + 1
+                self.__commit(self.__validated(changes))
+            else:
+                # the backend increments presses atomically
+                self.__backend.press(input, presses)
+            
+                if self.__subscribers:
+                    self.__changes.append((input, 1))
+                    
+                if self.scenario is not None:
+                    now = self.__now()
+                    self.__set_times[input] = now
+                    if presses is not None:
+                        self.__set_times[presses] = now
         
     def release(self, input):
         """Emulates releasing a button. 
@@ -231,9 +2264,9 @@ class State:
         associated value to 1 then to 0.
         """
         self.press(input)
-        sleep(delay)
+        self.sleep(delay)
         self.release(input)
-        sleep(delay)
+        self.sleep(delay)
         
     def power_on(self):
         """Emulates switching power off (meaning there will be output to the 
@@ -250,6 +2283,8 @@ class State:
         microbit_stub program during the tests.
         """
         self.__running_time = 0
+        self.__set_times = {}
+        self.clock.restart()
         self.set(State.__POWER_KEY, 0)
         
     def is_on(self):
@@ -267,14 +2302,16 @@ class State:
         Errors and exceptions during loading are ignored. This method has 
         no effect if the state file is empty, has an invalid format, does
         not exist etc.
+
+        Other backends load changes in the way described by their load 
+        method.
+        
+        Subscribers are notified of changes made through this state object
+        and of changes that have been loaded.
         """
-        try:
-            with open(self.__data[State.__STATE_FILE_KEY]) as f:
-                data = json.load(f)
-                self.__data = data
-        except:
-            pass
-    
+        self.__backend.load()
+        self.__notify()
+
     def dump(self):
         """Dump state to the current json format state file.
         
@@ -285,31 +2322,73 @@ class State:
         Errors and exceptions during dumping are ignored. This method has 
         no effect if the state file is empty, has an invalid format, does
         not exist etc.
+
+        Other backends save state in the way described by their dump 
+        method.
         """
-        try:
-            with open(self.__data[State.__STATE_FILE_KEY], 'w') as f:
-                json.dump(self.__data, f, sort_keys=True, indent=4,
-                            ensure_ascii=False)
-        except OSError:
-            pass
+        self.__backend.dump()
                             
     def reset(self):
         """Reset all state values and dump to the current state file.
         
         Reset values are 0 keys except for power, which is reset to 1, and 
         state_file, which is set as the current state file name.
+        
+        Within a transaction, the reset values are part of the transaction.
+        """
+        values = { State.__POWER_KEY:1 }
+        if self.__transaction is not None:
+            self.__commit(self.__validated({ k:values.get(k, 0) 
+                                for k in self.__keys 
+                                if k != State.__STATE_FILE_KEY }))
+        else:
+            self.__backend.reset(self.__validated(values))
+        
+    def snapshot(self):
+        """Returns a dictionary of all state values.
+        
+        While a scenario is playing, the values are those returned by get 
+        (see the play method).
         """
-        filename = self.__data[State.__STATE_FILE_KEY]
-        self.__data = { k:0 for k in self.__data.keys() }
-        self.__data[State.__STATE_FILE_KEY] = filename
-        self.__data[State.__POWER_KEY] = 1
-        self.dump()
+        data = self.__backend.snapshot()
+        if self.scenario is not None:
+            now = self.__now()
+            for key in data:
+                event = self.scenario.value_at(key, now)
+                if event is not None \
+                        and event[0] > self.__set_times.get(key, -1):
+                    data[key] = event[1]
+        return data
         
     def __str__(self):
+        data = self.snapshot()
         return '\n'.join([str(k) + ':' \
-                + str(self.__data[k]) for k in sorted(self.__data.keys())])
+                + str(data[k]) for k in sorted(data.keys())])
+
+class DeviceProxy:
+    """Refers to a component of the current Device.
+    
+    This is for emulation purposes - DeviceProxy is not part of the microbit
+    API. The module-level names (state, display, button_a etc.) are proxies
+    for the components of the same name of the current device, so that 
+    attributes of a proxy are attributes of the current device's component.
+    """
+    def __init__(self, name):
+        object.__setattr__(self, '_DeviceProxy__name', name)
+        
+    def __getattr__(self, attr):
+        return getattr(getattr(_device.get(), self.__name), attr)
+    
+    def __setattr__(self, attr, value):
+        setattr(getattr(_device.get(), self.__name), attr, value)
+        
+    def __str__(self):
+        return str(getattr(_device.get(), self.__name))
+    
+    def __repr__(self):
+        return repr(getattr(_device.get(), self.__name))
 
-state = State()
+state = DeviceProxy('state')
     
 
 """ ---------------------------------------------------------------------- """    
@@ -327,15 +2406,16 @@ class Button:
     with methods to test whether a button has been pressed and how many times
     """
 
-    def __init__(self, name=''):
+    def __init__(self, name='', state=state):
         self.__prev_presses = 0
+        self.__state = state
         self.name = name.lower()
         self.__presses_key = self.name + '_presses'
 
     def is_pressed(self):
         """If the button is pressed down, is_pressed() is True, else False.
         """
-        return state.get(self.name) > 0
+        return self.__state.get(self.name) > 0
             
     def was_pressed(self):
         """True if the button was pressed since the last time was_pressed()
@@ -349,17 +2429,17 @@ class Button:
     def get_presses(self):
         """Returns the running total of button presses.
         """
-        return state.get(self.__presses_key)
+        return self.__state.get(self.__presses_key)
     
     def reset_presses(self):
         """Reset the running total of button presses to zero.
         """
         self.__prev_presses = 0
         self.__local_presses = 0
-        state.set(self.__presses_key, 0)
+        self.__state.set(self.__presses_key, 0)
 
-button_a = Button('button_a')
-button_b = Button('button_b')
+button_a = DeviceProxy('button_a')
+button_b = DeviceProxy('button_b')
 
 
 """ ---------------------------------------------------------------------- """    
@@ -550,6 +2630,13 @@ class Image:
                                                                         
         return img
 
+    def copy(self):
+        """Returns an exact copy of the image.
+        """
+        img = Image()
+        img.__image = [list(row) for row in self.__image]
+        return img
+    
     def __repr__(self):
         """String representation that can be eval'ed to recreate image object.
         
@@ -846,6 +2933,229 @@ Image.CHARACTER_MAP = {
     }
 
 
+""" ---------------------------------------------------------------------- """    
+""" Display sinks - for the emulation not part of the microbit module ---- """
+class DisplaySink:
+    """Base class for the outputs of display frames.
+    
+    This is for emulation purposes - sinks are not part of the microbit 
+    API. While the microbit is on, the display passes each frame it shows
+    to the frame method of its sink, with the running time in milliseconds.
+    The image may be changed after the call (e.g. by display.set_pixel), so
+    a sink that keeps frames must copy them.
+    
+    Subclasses must implement frame. flush and close do nothing unless 
+    overridden.
+    """
+    def frame(self, image, time_ms):
+        """Outputs a frame of the display.
+        """
+        raise NotImplementedError
+    
+    def flush(self):
+        """Writes any frames held back by the sink.
+        """
+        pass
+    
+    def close(self):
+        """Flushes the sink and releases its resources.
+        """
+        self.flush()
+
+
+class TextSink(DisplaySink):
+    """Prints each frame as text (see Image.__str__) to the stream (the 
+    default sink). If stream is None, frames are printed to sys.stdout.
+    
+    If buffer_size is more than 0, frames are written to a reusable buffer
+    instead, and the buffer is written to the stream in one write when it
+    holds buffer_size characters, when its oldest frame is older than 
+    latency milliseconds, on sleep and at exit. Output printed by the 
+    program between sleeps may then appear before frames shown earlier.
+    Buffers older than their latency are written by one flusher thread, 
+    which is shared by all sinks.
+    """
+    __condition = threading.Condition()
+    __flusher = None
+    __sinks = weakref.WeakSet()
+    
+    def __init__(self, stream=None, buffer_size=display_buffer_size,
+                    latency=display_buffer_latency):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.latency = latency
+        self.__buffer = io.StringIO()
+        self.__target = None
+        self.__deadline = None
+        self.__lock = threading.Lock()
+        self.__stats = { 'frames': 0, 'writes': 0 }
+        
+        if buffer_size > 0:
+            _flushed_at_exit.add(self)
+        
+    def frame(self, image, time_ms):
+        self.__stats['frames'] += 1
+        if self.buffer_size <= 0:
+            print(image, file=self.stream)
+            self.__stats['writes'] += 1
+            return
+        
+        with self.__lock:
+            if self.__target is None:
+                # the stream when the first frame in the buffer was written
+                self.__target = sys.stdout if self.stream is None \
+                                else self.stream
+                if self.latency is not None:
+                    self.__deadline = time.monotonic() + self.latency/1000
+                    TextSink.__schedule(self)
+                
+            self.__buffer.write(str(image))
+            self.__buffer.write('\n')
+            if self.__buffer.tell() >= self.buffer_size:
+                self.__write()
+                
+    def __schedule(sink):
+        # wake the flusher thread (starting it if need be) for a deadline
+        with TextSink.__condition:
+            TextSink.__sinks.add(sink)
+            if TextSink.__flusher is None:
+                TextSink.__flusher = threading.Thread(
+                        target=TextSink.__flush_due, name='TextSink flusher',
+                        daemon=True)
+                TextSink.__flusher.start()
+            TextSink.__condition.notify()
+            
+    def __flush_due():
+        # the flusher thread: writes the buffers that are older than their 
+        # latency, then waits for the next deadline
+        while True:
+            with TextSink.__condition:
+                due, timeout = TextSink.__due()
+                if not due:
+                    TextSink.__condition.wait(timeout)
+                    continue
+                
+            for sink in due:
+                sink.flush()
+            # so that unused sinks are not kept while waiting
+            due = sink = None
+            
+    def __due():
+        # the sinks with buffers older than their latency and the seconds 
+        # until the next deadline (or None)
+        now = time.monotonic()
+        pending = [(s, s.__deadline) for s in list(TextSink.__sinks)]
+        pending = [(s, d) for s, d in pending if d is not None]
+        due = [s for s, d in pending if d <= now]
+        return due, min(d for s, d in pending) - now if pending else None
+                
+    def __forked():
+        # the flusher thread is not in a forked child process
+        TextSink.__condition = threading.Condition()
+        TextSink.__flusher = None
+            
+    def __write(self):
+        # write the buffer to the stream (with the lock held)
+        self.__deadline = None
+        if self.__target is not None:
+            self.__target.write(self.__buffer.getvalue())
+            self.__target.flush()
+            self.__stats['writes'] += 1
+            self.__buffer.seek(0)
+            self.__buffer.truncate()
+            self.__target = None
+        
+    def flush(self):
+        """Writes any buffered frames to the stream.
+        """
+        with self.__lock:
+            self.__write()
+            
+    def stats(self):
+        """Returns a dictionary of counters: frames is the number of frames
+        and writes is the number of writes to the stream.
+        """
+        return dict(self.__stats)
+
+
+class NullSink(DisplaySink):
+    """Discards frames.
+    """
+    def frame(self, image, time_ms):
+        pass
+    
+    
+class FrameListSink(DisplaySink):
+    """Keeps frames in memory as a list of (time_ms, image) tuples.
+    """
+    def __init__(self):
+        self.frames = []
+        
+    def frame(self, image, time_ms):
+        self.frames.append((time_ms, image.copy()))
+        
+
+class RecorderSink(DisplaySink):
+    """Records frames to a binary file.
+    
+    Each frame is recorded as its running time (4 bytes, little-endian), 
+    width and height (1 byte each) and a byte for each pixel, row by row.
+    The file is either a file name, which is created, or a binary file 
+    object. Frames are written through the file's buffer, which is flushed
+    at exit. Use the read function to read a recording.
+    """
+    __HEADER = struct.Struct('<IBB')
+    
+    def __init__(self, file):
+        self.__own = isinstance(file, str)
+        self.__file = open(file, 'wb') if self.__own else file
+        _flushed_at_exit.add(self)
+        
+    def frame(self, image, time_ms):
+        pixels = image._Image__image
+        header = RecorderSink.__HEADER.pack(time_ms & 0xffffffff, 
+                    len(pixels[0]) if pixels else 0, len(pixels))
+        self.__file.write(header + bytes(p for row in pixels for p in row))
+        
+    def flush(self):
+        if not self.__file.closed:
+            self.__file.flush()
+            
+    def close(self):
+        _flushed_at_exit.discard(self)
+        if self.__own:
+            self.__file.close()
+        else:
+            self.flush()
+        
+    def read(file):
+        """Yields the (time_ms, image) tuples of frames recorded in a file 
+        (a file name or a binary file object).
+        """
+        header = RecorderSink.__HEADER
+        with contextlib.ExitStack() as stack:
+            if isinstance(file, str):
+                file = stack.enter_context(open(file, 'rb'))
+            while True:
+                data = file.read(header.size)
+                if len(data) < header.size:
+                    break
+                time_ms, width, height = header.unpack(data)
+                pixels = array.array('B', file.read(width * height))
+                yield (time_ms, Image(width, height, pixels) 
+                                if width and height else Image(''))
+            
+    
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=TextSink._TextSink__forked)
+    
+DISPLAY_SINKS = {
+    'frames': FrameListSink,
+    'null': NullSink,
+    'text': TextSink,
+    }
+
+
 """ ---------------------------------------------------------------------- """    
 """ The LED display ------------------------------------------------------ """
 class Display:
@@ -853,13 +3163,33 @@ class Display:
     __DELAY_DEFAULT_ITER = 400
     """Display class represents the 5x5 LED display. 
     
-    There is a single display object that has an image.
+    There is a display object for each Device. It has an image.
+    For the emulation, frames are output to a DisplaySink, which is either
+    a DisplaySink object or the name of one of the DISPLAY_SINKS: 'text' 
+    (the default) prints frames, 'null' discards them and 'frames' keeps 
+    them in memory.
     """
-    def __init__(self):
+    def __init__(self, state=state, sink=display_sink):
         """Initialise the display.
         """
+        if isinstance(sink, str):
+            if sink not in DISPLAY_SINKS:
+                raise ValueError('unknown display sink ' + sink)
+            sink = DISPLAY_SINKS[sink]()
+            
         self.image = Image()
+        self.sink = sink
         self.__last_image = None
+        self.__state = state
+        if isinstance(state, State):
+            # the display whose frames are flushed and image observed by 
+            # sleeps of the state
+            state._State__display = self
+        
+    def __output(self, image):
+        # outputs a frame to the sink if the microbit is on
+        if self.__state.is_on():
+            self.sink.frame(image, self.__state._State__now())
 
     def get_pixel(self, x, y):
         """Gets the brightness of LED pixel (x,y).
@@ -874,15 +3204,15 @@ class Display:
         b can be between 0 (off) and 9 (max brightness).
         """
         self.image.set_pixel(x, y, val)
-        if state.is_on():
-            print(self.image)
+        self.__state._State__spend('frames')
+        self.__output(self.image)
 
     def clear(self):
         """Clear the display.
         """
         self.image = Image()
-        if state.is_on():
-            print(self.image)
+        self.__state._State__spend('frames')
+        self.__output(self.image)
         
     def show(self, iterable, **kargs):
         """Show images or a string on the display.
@@ -897,6 +3227,20 @@ class Display:
         show each image or letter in the iterable:
         display.show(iterable, delay=400, wait=True, loop=False, clear=False)
         """
+        for delay in self.__show(iterable, **kargs):
+            self.__state.sleep(delay)
+            
+    async def show_async(self, iterable, **kargs):
+        """Show images or a string on the display, awaiting the delays 
+        between images/characters (see show and sleep_async).
+        
+        This is for emulation purposes - it is not part of the microbit API.
+        """
+        for delay in self.__show(iterable, **kargs):
+            await self.__state.sleep_async(delay)
+            
+    def __show(self, iterable, **kargs):
+        # shows the images, yielding the delay to sleep before each image
         if iterable is None:
             raise TypeError('not iterable')
             
@@ -936,9 +3280,10 @@ class Display:
             
         for img in iterable:
             if delay:
-                sleep(delay)
-            if state.is_on() and img != self.__last_image:
-                print(img)
+                yield delay
+            self.__state._State__spend('frames')
+            if self.__state.is_on() and img != self.__last_image:
+                self.__output(img)
                 self.__last_image = img
 
         if loop:
@@ -947,7 +3292,7 @@ class Display:
         if clear:
             self.clear()
         else:
-            self.image = eval(repr(img))
+            self.image = img.copy()
             
     def scroll(self, string, delay=400):
         """Scroll the string across the display with given delay.
@@ -955,22 +3300,38 @@ class Display:
         In this emulation this is the same as showing the string and clearing
         the screen.
         """
+        for delay in self.__scroll(string, delay):
+            self.__state.sleep(delay)
+            
+    async def scroll_async(self, string, delay=400):
+        """Scroll the string across the display, awaiting the delays between
+        characters (see scroll and sleep_async).
+        
+        This is for emulation purposes - it is not part of the microbit API.
+        """
+        for delay in self.__scroll(string, delay):
+            await self.__state.sleep_async(delay)
+        
+    def __scroll(self, string, delay):
+        # scrolls the string, yielding the delay to sleep before each char
         for c in string:
             if delay:
-                sleep(delay)
-            if state.is_on():
-                print(Image.CHARACTER_MAP.get(c, Image.CHARACTER_MAP.get('?')))
+                yield delay
+            self.__state._State__spend('frames')
+            self.__output(Image.CHARACTER_MAP.get(c, 
+                                                Image.CHARACTER_MAP.get('?')))
         
         self.clear()
         
-display = Display()
+display = DeviceProxy('display')
 
 
 """ ---------------------------------------------------------------------- """    
 """ Pins ----------------------------------------------------------------- """
 class Pin:
-    def __init__(self, name):
+    def __init__(self, name, state=state):
         self.__name = name.lower()
+        self.__state = state
         
     def write_digital(self, value):
         """Write a value to the pin that must be either 0, 1, True  or False.
@@ -978,22 +3339,22 @@ class Pin:
         if value < 0 or value > 1:
             raise ValueError('value must be 0 or 1')
 
-        state.set(self.__name, 1 if value else 0)
+        self.__state.set(self.__name, 1 if value else 0)
               
     def read_digital(self):
         """Return the pin's value, which will be either 1 or 0.
         """
-        return 1 if state.get(self.__name) else 0
+        return 1 if self.__state.get(self.__name) else 0
     
     def write_analog(self, value):
         """Write a value to the pin that must be between 0 and 1023.
         """
-        state.set(self.__name, value)   # value check deferred to state
+        self.__state.set(self.__name, value)   # value check deferred to state
             
     def read_analog(self):
         """Returns the pin's value, which will be between 0 and 1023
         """
-        return state.get(self.__name)
+        return self.__state.get(self.__name)
         
 
     def set_analog_period(self, int):
@@ -1015,27 +3376,27 @@ class Pin:
     def is_touched(self):
         """Return True if the pin is being touched, False otherwise.
         """
-        return state.get(self.__name) > 0
-        
-pin0 = Pin('pin0')
-pin1 = Pin('pin1')
-pin2 = Pin('pin2')
-pin3 = Pin('pin3')
-pin4 = Pin('pin4')
-pin5 = Pin('pin5')
-pin6 = Pin('pin6')
-pin7 = Pin('pin7')
-pin8 = Pin('pin8')
-pin9 = Pin('pin9')
-pin10 = Pin('pin10')
-pin11 = Pin('pin11')
-pin12 = Pin('pin12')
-pin13 = Pin('pin13')
-pin14 = Pin('pin14')
-pin15 = Pin('pin15')
-pin16 = Pin('pin16')
-pin19 = Pin('pin19')
-pin20 = Pin('pin20')
+        return self.__state.get(self.__name) > 0
+        
+pin0 = DeviceProxy('pin0')
+pin1 = DeviceProxy('pin1')
+pin2 = DeviceProxy('pin2')
+pin3 = DeviceProxy('pin3')
+pin4 = DeviceProxy('pin4')
+pin5 = DeviceProxy('pin5')
+pin6 = DeviceProxy('pin6')
+pin7 = DeviceProxy('pin7')
+pin8 = DeviceProxy('pin8')
+pin9 = DeviceProxy('pin9')
+pin10 = DeviceProxy('pin10')
+pin11 = DeviceProxy('pin11')
+pin12 = DeviceProxy('pin12')
+pin13 = DeviceProxy('pin13')
+pin14 = DeviceProxy('pin14')
+pin15 = DeviceProxy('pin15')
+pin16 = DeviceProxy('pin16')
+pin19 = DeviceProxy('pin19')
+pin20 = DeviceProxy('pin20')
 
 
 """ ---------------------------------------------------------------------- """    
@@ -1043,30 +3404,30 @@ pin20 = Pin('pin20')
 class Accelerometer:
     """Accelerometer class represents the accelerometer. 
     
-    There is a single accelerometer object.
+    There is an accelerometer object for each Device.
     x, y, z axes are set through State object or via state file.
     Gestures are generated randomly from a list.
     """
     gestures = ['', 'up', 'down', 'left', 'face up', 'face down', 'freefall', 
                 '3g', '6g', '8g', 'shake']
 
-    def __init__(self):
-        pass
+    def __init__(self, state=state):
+        self.__state = state
         
     def get_x(self):
         """Returns the X axis of the device, measure in milli-g.
         """
-        return state.get('accelerometer_x')
+        return self.__state.get('accelerometer_x')
         
     def get_y(self):
         """Returns the Y axis of the device, measure in milli-g.
         """
-        return state.get('accelerometer_y')
+        return self.__state.get('accelerometer_y')
         
     def get_z(self):
         """Returns the Z axis of the device, measure in milli-g.
         """
-        return state.get('accelerometer_z')
+        return self.__state.get('accelerometer_z')
         
     def get_values(self):
         """Returns all three X, Y and Z readings (in that order).
@@ -1113,14 +3474,14 @@ class Accelerometer:
         """
         pass
 
-accelerometer = Accelerometer()
+accelerometer = DeviceProxy('accelerometer')
 
 """ ---------------------------------------------------------------------- """    
 """ The compass ---------------------------------------------------------- """
 class Compass:
     """Compass class represents the compass. 
     
-    There is a single compass object.
+    There is a compass object for each Device.
     
     Emulate position by generating random number for degrees offset
     from "north" and field strength by generating random number of microTeslas
@@ -1169,7 +3530,72 @@ class Compass:
         """
         self.__calibrated = False
         
-compass = Compass()
+compass = DeviceProxy('compass')
+
+
+""" ---------------------------------------------------------------------- """    
+""" Devices - for the emulation not part of the microbit module ---------- """
+class Device:
+    """An emulated microbit with its own state, display, buttons, pins, 
+    accelerometer and compass.
+    
+    This is for emulation purposes - Device is not part of the microbit API.
+    The module-level names (state, display, button_a, button_b, pin0 to 
+    pin20, accelerometer and compass) refer to the components of the 
+    current device. The current device is set for the current context 
+    (e.g. thread or asyncio task, see the contextvars module) by a with 
+    statement:
+    
+        with Device(state_backend='memory'):
+            ... # code that uses the device through the module-level names
+    
+    Where no other device is current, the default device is current. It 
+    uses the settings. The display_sink is as for Display and other 
+    arguments are passed to State.
+    """
+    PINS = ['pin0', 'pin1', 'pin2', 'pin3', 'pin4', 'pin5', 'pin6', 'pin7',
+            'pin8', 'pin9', 'pin10', 'pin11', 'pin12', 'pin13', 'pin14',
+            'pin15', 'pin16', 'pin19', 'pin20']
+    
+    def __init__(self, *args, display_sink=display_sink, **kwargs):
+        self.state = State(*args, **kwargs)
+        self.display = Display(self.state, display_sink)
+        self.button_a = Button('button_a', self.state)
+        self.button_b = Button('button_b', self.state)
+        for name in Device.PINS:
+            setattr(self, name, Pin(name, self.state))
+        self.accelerometer = Accelerometer(self.state)
+        self.compass = Compass()
+        self.__tokens = []
+        
+    def current():
+        """Returns the current device.
+        """
+        return _device.get()
+        
+    def __enter__(self):
+        self.__tokens.append(_device.set(self))
+        return self
+    
+    def __exit__(self, *exc_info):
+        _device.reset(self.__tokens.pop())
+        
+    def run_program(self, program, ms=None, sleeps=None, frames=None):
+        """Runs the program with this device as the current device (see
+        the run_program function).
+        """
+        with self:
+            return run_program(program, ms, sleeps, frames)
+        
+    async def run_program_async(self, program, ms=None, sleeps=None, 
+                                frames=None):
+        """Runs the program with this device as the current device of the
+        current task (see the run_program_async function).
+        """
+        with self:
+            return await run_program_async(program, ms, sleeps, frames)
+
+_device = contextvars.ContextVar('device', default=Device())
 
 """ ---------------------------------------------------------------------- """    
 """ I2C bus -------------------------------------------------------------- """
@@ -1234,19 +3660,94 @@ uart = UART()
 def sleep(ms):
     """sleep for the given number of milliseconds.
     
-    For the emulation, state is reloaded after sleep.
+    For the emulation, held back state changes and display frames are 
+    flushed before sleep and state is reloaded after sleep, then scheduled
+    state changes that are due are made. If the state clock is virtual, 
+    sleep does not block. If it is scheduled, idle sleeps by the program 
+    skip to the next scheduled change (see the Clock class). The sleep is
+    counted against the run budget (see State.budget).
+    """
+    state._State__sleep(ms, sys._getframe(1))
+    
+async def sleep_async(ms):
+    """sleep for the given number of milliseconds without blocking other 
+    asyncio tasks.
+    
+    This is for emulation purposes - it is not part of the microbit API.
+    It is the same as sleep, except that it awaits the sleep. If the state
+    clock is virtual, it yields to other tasks, so that the devices of many
+    tasks can run in one event loop. Programs run by run_program_async 
+    with virtual clocks wake in order of running time (see 
+    run_program_async).
     """
-    if ms > 0:
-        time.sleep(ms/1000)
-        state._State__incr_runtime(ms)
+    await state._State__sleep_async(ms, sys._getframe(1))
     
-    state.load()
+_PLAIN_TYPES = (type(None), bool, int, float, complex, str, bytes, range)
+_CONTAINER_TYPES = (tuple, list, set, frozenset)
+
+def _describe(value, module):
+    # a description of the value that changes when anything it holds does,
+    # or TypeError if the value may hold something that is not shown (e.g.
+    # an object of a type implemented in C)
+    if isinstance(value, _PLAIN_TYPES) or type(value) is Image:
+        return value
+    if isinstance(value, type(sys)) or callable(value) and not (
+                isinstance(value, type) and value.__module__ == module):
+        # code rather than values
+        return type(value).__name__
+    if isinstance(value, _CONTAINER_TYPES):
+        return (type(value).__name__, 
+                    [_describe(item, module) for item in value])
+    if isinstance(value, dict):
+        return [(_describe(k, module), _describe(v, module)) 
+                    for k, v in value.items()]
+    if isinstance(value, type) and value.__module__ == module:
+        # the class attributes of a class of the program
+        return (value.__qualname__, _describe({ k:v 
+                for k, v in vars(value).items() if not k.startswith('__') 
+                    and not callable(v) and not hasattr(v, '__get__') }, 
+                module))
+    if type(value).__module__ == __name__:
+        # emulated components keep their values in the state
+        return type(value).__name__
+    if hasattr(value, '__dict__') and all(t.__module__ == module 
+                        for t in type(value).__mro__ if t is not object):
+        return (type(value).__qualname__, _describe(vars(value), module))
+    raise TypeError('cannot describe ' + type(value).__name__)
+
+def _values_digest(caller):
+    # a digest of the variables of the program frames up to the caller (and 
+    # of the random number generator), or a new object (never equal to an 
+    # earlier digest) if a variable cannot be described
+    frames = []
+    frame = caller
+    while frame is not None and frame.f_globals is caller.f_globals:
+        if frame.f_locals is not caller.f_globals:
+            frames.append(frame.f_locals)
+        frame = frame.f_back
+    frames.append(caller.f_globals)
+    module = caller.f_globals.get('__name__')
     
+    digest = hashlib.sha1(repr(random.getstate()).encode('utf-8'))
+    for variables in frames:
+        for name, value in sorted(variables.items(), key=lambda v: v[0]):
+            if name.startswith('__'):
+                continue
+            try:
+                value = _describe(value, module)
+            except (TypeError, RecursionError):
+                return object()
+            digest.update(repr((name, value)).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.digest()
+
 def running_time():
     """returns the number of ms since the micro:bit was last switched on.
     
     Simply returns an int that takes account of the delays caused by 
-    calls to sleep and a random increment to runing time of up to 100ms.
+    calls to sleep and a random increment to runing time of up to 100ms
+    (or an increment of 1ms if the state clock is virtual). If the state
+    clock is monotonic, returns the real time elapsed since power on.
     """
     state._State__incr_runtime(1, True)
     
@@ -1284,12 +3785,409 @@ def reset():
     
 
 
+""" ---------------------------------------------------------------------- """    
+""" Running programs - for the emulation not part of the microbit module - """
+
+def run_program(program, ms=None, sleeps=None, frames=None):
+    """Runs a microbit program with a run budget and returns a report of 
+    how far it got.
+    
+    The program is either the name of a Python file, which is run as 
+    __main__, or a function with no arguments. The budget is as for 
+    State.budget and is removed when the program ends.
+    
+    The report is a dictionary of progress (see State.progress) and a 
+    status: 'finished' if the program ended (or exited), 'budget' if its
+    budget was exhausted, 'stopped' if it was stopped when idle in 
+    scheduled time mode, or 'error' if it raised an exception, in which 
+    case error is the representation of the exception.
+    """
+    report = {}
+    with _reporting(report, ms, sleeps, frames):
+        _run(program)
+    
+    return report
+
+async def run_program_async(program, ms=None, sleeps=None, frames=None):
+    """Runs a microbit program in the current asyncio task with a run 
+    budget and returns a report of how far it got (see run_program).
+    
+    The program is either a coroutine function with no arguments, which 
+    is awaited, the name of a Python file or a function returned by 
+    compile_program, which is run cooperatively (awaiting each sleep), or
+    a function with no arguments, which blocks, so is run in a thread with
+    the current context (so that it uses the current device). A coroutine
+    function uses sleep_async and the async display methods.
+    
+    If the clock is virtual, the cooperative programs run by 
+    run_program_async in an event loop share a timeline: a sleeping 
+    program wakes when every other such program is sleeping and none wakes
+    at an earlier running time (as with Scheduler), rather than in turn.
+    """
+    if isinstance(program, str):
+        program = compile_program(program)
+    
+    report = {}
+    timeline = None
+    if state.clock.is_virtual() and (asyncio.iscoroutinefunction(program) 
+                                or inspect.isgeneratorfunction(program)):
+        timeline = _Timeline.of(asyncio.get_running_loop())
+        timeline.enter()
+    token = _timeline.set(timeline)
+    try:
+        with _reporting(report, ms, sleeps, frames):
+            if asyncio.iscoroutinefunction(program):
+                await program()
+            elif inspect.isgeneratorfunction(program):
+                for delay in program():
+                    await state._State__wait_async(delay)
+            else:
+                await asyncio.to_thread(_run, program)
+    finally:
+        _timeline.reset(token)
+        if timeline is not None:
+            timeline.leave()
+            
+    return report
+
+def _run(program):
+    # runs a program file as __main__, a compiled program or a function
+    if inspect.isgeneratorfunction(program):
+        for ms in program():
+            state.clock.sleep(ms)
+    elif callable(program):
+        program()
+    else:
+        runpy.run_path(program, run_name='__main__')
+        
+class _Timeline:
+    # orders the virtual sleeps of the programs run by run_program_async in
+    # an event loop by the running time at which they wake
+    __timelines = weakref.WeakKeyDictionary()
+    
+    def __init__(self):
+        self.__programs = 0
+        self.__waiting = []
+        self.__count = 0
+        self.__pending = False
+        
+    def of(loop):
+        # the timeline of the event loop
+        timeline = _Timeline.__timelines.get(loop)
+        if timeline is None:
+            timeline = _Timeline.__timelines[loop] = _Timeline()
+        return timeline
+        
+    def enter(self):
+        self.__programs += 1
+        
+    def leave(self):
+        self.__programs -= 1
+        self.__wake()
+        
+    async def wait(self, running_time):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.__waiting, (running_time, self.__count, future))
+        self.__count += 1
+        self.__wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            self.__waiting = [w for w in self.__waiting if w[2] is not future]
+            heapq.heapify(self.__waiting)
+            raise
+        
+    def __wake(self):
+        # wake after the tasks that are ready to run (e.g. programs that are 
+        # starting) have run
+        if not self.__pending:
+            self.__pending = True
+            asyncio.get_running_loop().call_soon(self.__dispatch)
+            
+    def __dispatch(self):
+        # when every program is waiting, the earliest wakes
+        self.__pending = False
+        while self.__waiting and len(self.__waiting) >= self.__programs:
+            future = heapq.heappop(self.__waiting)[2]
+            if not future.done():
+                future.set_result(None)
+                break
+
+_timeline = contextvars.ContextVar('timeline', default=None)
 
+@contextlib.contextmanager
+def _reporting(report, ms, sleeps, frames):
+    # runs the body with a budget and sets the status and progress of report
+    state.budget(ms, sleeps, frames)
+    report['status'] = 'finished'
+    try:
+        yield report
+    except BudgetExhausted:
+        report['status'] = 'budget'
+    except EmulationStopped:
+        report['status'] = 'stopped'
+    except SystemExit:
+        pass
+    except Exception as e:
+        report['status'] = 'error'
+        report['error'] = repr(e)
+        
+    report.update(state.progress())
+    state.budget()
 
 
+""" ---------------------------------------------------------------------- """    
+""" Cooperative programs - for the emulation not part of the microbit module """
 
+def compile_program(filename):
+    """Compiles a microbit program file into a generator function that 
+    runs the program cooperatively.
+    
+    The program text is not changed. Instead, its syntax tree is rewritten
+    so that calls to sleep, display.show and display.scroll yield the 
+    number of milliseconds to sleep (after the same state changes as 
+    sleep), and so do direct calls to the program's (undecorated) 
+    top-level functions that make such calls. Whatever runs the generator 
+    sleeps for that time before resuming it (see Scheduler and 
+    run_program_async). The program is run as __main__ in a new namespace
+    each time the function is called. 
+    
+    Such a function is kept unchanged and the direct calls are to a 
+    generator twin of it. Other calls (e.g. through a dictionary, from a 
+    comprehension or a nested function, or as a value passed to map) call
+    the unchanged function, so they still sleep (which does not block with
+    a virtual clock), but do not yield. So do calls within lambdas, 
+    comprehensions, classes and nested functions.
+    """
+    with open(filename) as f:
+        tree = ast.parse(f.read(), filename)
+    
+    # top-level imports of * must stay at module level
+    imports = [node for node in tree.body if isinstance(node, ast.ImportFrom)
+                and any(alias.name == '*' for alias in node.names)]
+    body = [node for node in tree.body 
+            if node not in imports and not isinstance(node, ast.Global)]
+    
+    # functions that sleep, including those that call functions that sleep
+    defs = [node for node in body if isinstance(node, ast.FunctionDef)
+            and not node.decorator_list]
+    functions = set()
+    while True:
+        sleepers = set(node.name for node in defs 
+                        if _ProgramTransformer.yields(node, functions))
+        if sleepers <= functions:
+            break
+        functions |= sleepers
+    
+    transformer = _ProgramTransformer(functions)
+    for node in list(body):
+        if isinstance(node, ast.FunctionDef):
+            if node.name in functions:
+                twin = copy.deepcopy(node)
+                twin.name = _ProgramTransformer.twin(node.name)
+                transformer.generic_visit(twin)
+                body.insert(body.index(node) + 1, twin)
+        else:
+            transformer.visit(node)
+    
+    names = _ProgramNames()
+    for node in body:
+        names.visit(node)
+        
+    program = ast.parse('def __microbit_program__():\n'
+                        '    if False:\n'
+                        '        yield\n').body[0]
+    if names.names:
+        program.body.insert(0, ast.Global(names=sorted(names.names)))
+    program.body.extend(body)
+    
+    module = ast.Module(body=imports + [program], type_ignores=[])
+    code = compile(ast.fix_missing_locations(module), filename, 'exec')
+    
+    def run():
+        program_globals = { '__name__': '__main__', '__file__': filename,
+                            '__builtins__': __builtins__,
+                            '__microbit_sleep__': _sleep_steps,
+                            '__microbit_show__': _show_steps,
+                            '__microbit_scroll__': _scroll_steps }
+        exec(code, program_globals)
+        yield from program_globals['__microbit_program__']()
+    
+    return run
 
+class _ProgramTransformer(ast.NodeTransformer):
+    # rewrites calls that sleep in a program as yield from their steps
+    __MODULES = ('microbit', 'microbit_stub')
+    
+    def __init__(self, functions):
+        self.functions = functions
+        self.rewritten = False
+        
+    def yields(node, functions):
+        # whether the function node calls functions that sleep
+        transformer = _ProgramTransformer(functions)
+        transformer.generic_visit(copy.deepcopy(node))
+        return transformer.rewritten
+    
+    def __module(node):
+        return isinstance(node, ast.Name) \
+                and node.id in _ProgramTransformer.__MODULES
+    
+    def twin(name):
+        # the name of the generator twin of a function that sleeps
+        return '__microbit_gen_' + name
+    
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        
+        func = node.func
+        if isinstance(func, ast.Attribute) \
+                and _ProgramTransformer.__module(func.value):
+            func = ast.copy_location(ast.Name(id=func.attr, ctx=ast.Load()),
+                                        func)
+        args = node.args
+        
+        if isinstance(func, ast.Name) and func.id == 'sleep':
+            func = ast.Name(id='__microbit_sleep__', ctx=ast.Load())
+        elif isinstance(func, ast.Name) and func.id in self.functions:
+            func = ast.copy_location(ast.Name(
+                    id=_ProgramTransformer.twin(func.id), ctx=ast.Load()), func)
+        elif isinstance(func, ast.Attribute) \
+                and func.attr in ('show', 'scroll') \
+                and ((isinstance(func.value, ast.Name) 
+                        and func.value.id == 'display') 
+                    or (isinstance(func.value, ast.Attribute)
+                        and func.value.attr == 'display'
+                        and _ProgramTransformer.__module(func.value.value))):
+            args = [func.value] + args
+            func = ast.Name(id='__microbit_' + func.attr + '__', 
+                            ctx=ast.Load())
+        else:
+            return node
+        
+        self.rewritten = True
+        call = ast.Call(func=func, args=args, keywords=node.keywords)
+        return ast.copy_location(ast.YieldFrom(value=call), node)
+    
+    # scopes that cannot yield for the program
+    def __skip(self, node):
+        return node
+    
+    visit_FunctionDef = visit_AsyncFunctionDef = visit_ClassDef = __skip
+    visit_Lambda = visit_ListComp = visit_SetComp = visit_DictComp = __skip
+    visit_GeneratorExp = __skip
 
+class _ProgramNames(ast.NodeVisitor):
+    # collects the names bound by the top-level statements of a program
+    def __init__(self):
+        self.names = set()
+        
+    def visit_Name(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            self.names.add(node.id)
+            
+    def visit_Import(self, node):
+        for alias in node.names:
+            self.names.add(alias.asname or alias.name.split('.')[0])
+            
+    visit_ImportFrom = visit_Import
+    
+    def visit_ExceptHandler(self, node):
+        if node.name:
+            self.names.add(node.name)
+        self.generic_visit(node)
+            
+    def visit_FunctionDef(self, node):
+        self.names.add(node.name)
+        for decorator in node.decorator_list:
+            self.visit(decorator)
+            
+    visit_AsyncFunctionDef = visit_ClassDef = visit_FunctionDef
+    
+    # scopes with their own names
+    def __skip(self, node):
+        pass
+    
+    visit_Lambda = visit_ListComp = visit_SetComp = visit_DictComp = __skip
+    visit_GeneratorExp = __skip
+    
+def _sleep_steps(ms, state=state):
+    # sleep, yielding the ms to sleep to the scheduler, which sleeps
+    ms = state._State__sleep_start(ms, sys._getframe(1))
+    yield ms
+    state._State__sleep_end(ms)
+    
+def _show_steps(target, iterable, **kargs):
+    # display.show, yielding each delay
+    for delay in target._Display__show(iterable, **kargs):
+        yield from _sleep_steps(delay, target._Display__state)
 
+def _scroll_steps(target, string, delay=400):
+    # display.scroll, yielding each delay
+    for delay in target._Display__scroll(string, delay):
+        yield from _sleep_steps(delay, target._Display__state)
+        
+def _program_steps(program, report, ms, sleeps, frames):
+    # runs a compiled program with a budget and sets the report at the end
+    with _reporting(report, ms, sleeps, frames):
+        yield from program()
 
 
+class Scheduler:
+    """Runs many microbit programs cooperatively in one thread.
+    
+    This is for emulation purposes - Scheduler is not part of the microbit
+    API. Programs are compiled with compile_program, so that each sleep 
+    (including the delays of display.show and display.scroll) returns 
+    control to the scheduler. The program with the earliest running time
+    runs next, so all programs advance together in virtual time. Each 
+    program has its own device, which is current while it runs.
+    
+    Usage:
+        scheduler = Scheduler()
+        reports = [scheduler.add('bitcounter-range.py', ms=10000) 
+                    for i in range(10000)]
+        scheduler.run()
+    """
+    def __init__(self):
+        self.__ready = []
+        self.__count = 0
+        
+    def add(self, program, device=None, ms=None, sleeps=None, frames=None):
+        """Adds a program and returns its report (see run_program), which is
+        filled in when the program ends.
+        
+        The program is either the name of a Python file or a function 
+        returned by compile_program (so that a file can be compiled once 
+        and run many times). If no device is given, the program has a new
+        device with a memory state and a virtual clock. The budget is as
+        for State.budget.
+        """
+        if not callable(program):
+            program = compile_program(program)
+        if device is None:
+            device = Device(state_backend='memory', clock=Clock('virtual'))
+            
+        report = {}
+        self.__push(0, device, 
+                    _program_steps(program, report, ms, sleeps, frames))
+        return report
+    
+    def __push(self, running_time, device, steps):
+        heapq.heappush(self.__ready, (running_time, self.__count, device, 
+                                        steps))
+        self.__count += 1
+        
+    def run(self):
+        """Runs the programs until they have all ended.
+        """
+        while self.__ready:
+            running_time, count, device, steps = heapq.heappop(self.__ready)
+            with device:
+                try:
+                    ms = next(steps)
+                except StopIteration:
+                    continue
+                state.clock.sleep(ms)
+                # the running time at which the program wakes
+                self.__push(state._State__now() + ms, device, steps)
@@ -0,0 +1,542 @@
+"""
+------------------------------------------------------------------------------
+The MIT License (MIT)
+
+Copyright (c) 2016 Newcastle University
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+------------------------------------------------------------------------------
+Batch grading of microbit programs with microbit_stub.
+
+Runs every program in a directory against every scenario of input events
+(see microbit_stub.Scenario) in a pool of processes and writes a json line
+for each run as it finishes. For example:
+
+    python -m microbit_stub_grade submissions/ scenarios/*.jsonl --ms 60000
+
+Each run has its own device with an isolated state (in memory by default, or
+in a temporary directory for file based backends), so runs never share
+microbit_state.json. Each run is limited to a CPU time and each process to a
+memory size.
+------------------------------------------------------------------------------
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import selectors
+import signal
+import sys
+import tempfile
+import time
+
+import microbit_stub
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+TIME_MODE_DEFAULT = 'virtual'
+MS_DEFAULT = 60000
+CPU_LIMIT_DEFAULT = 10
+MEMORY_LIMIT_DEFAULT = 1 << 30
+STATE_BACKEND_DEFAULT = 'memory'
+CACHE_SIZE_DEFAULT = 1 << 28
+
+
+def grade(programs, scenarios=(None,), workers=None,
+            time_mode=TIME_MODE_DEFAULT, ms=MS_DEFAULT, sleeps=None,
+            frames=None, cpu_limit=CPU_LIMIT_DEFAULT,
+            memory_limit=MEMORY_LIMIT_DEFAULT,
+            state_backend=STATE_BACKEND_DEFAULT, cache=None):
+    """Runs each program against each scenario in a pool of worker
+    processes and yields the result of each run as it finishes.
+
+    A scenario is the name of a scenario file or None for no input events.
+    The budget (ms, sleeps and frames) is as for State.budget. cpu_limit is
+    the CPU time in seconds of a run and memory_limit is the address space
+    in bytes of a worker process (None for no limit).
+
+    A result is a dictionary of the program, the scenario, the report of
+    the run (see microbit_stub.run_program), the display frames (images, a
+    list of [time_ms, image representation]), the output printed by the 
+    program, the final state and the cpu_time in seconds. The status of a
+    run that used its CPU time is 'cpu'. If a worker process dies, the 
+    runs it was part of are retried once in a new pool, then have the 
+    status 'crashed'.
+    
+    If a ResultCache is given, results are first looked up in the cache,
+    and the results of runs are stored in it.
+    """
+    options = { 'time_mode': time_mode, 'ms': ms, 'sleeps': sleeps,
+                'frames': frames, 'cpu_limit': cpu_limit,
+                'state_backend': state_backend }
+    jobs = []
+    keys = {}
+    for program in programs:
+        for scenario in scenarios:
+            key, result = _cached(cache, program, scenario, options, 
+                                    memory_limit)
+            if result is not None:
+                yield result
+            else:
+                jobs.append((program, scenario))
+                keys[(program, scenario)] = key
+    attempts = {}
+
+    while jobs:
+        broken = []
+        with concurrent.futures.ProcessPoolExecutor(workers,
+                    mp_context=_context(), initializer=_init_worker,
+                    initargs=(memory_limit,)) as pool:
+            futures = { pool.submit(_run, program, scenario, options):
+                        (program, scenario) for program, scenario in jobs }
+
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    result = future.result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    job = futures[future]
+                    attempts[job] = attempts.get(job, 0) + 1
+                    if attempts[job] > 1:
+                        yield { 'program': job[0], 'scenario': job[1],
+                                'status': 'crashed' }
+                    else:
+                        broken.append(job)
+                except Exception as e:
+                    # e.g. a result that cannot be returned, which must not
+                    # stop the other runs
+                    job = futures[future]
+                    yield { 'program': job[0], 'scenario': job[1],
+                            'status': 'error', 'error': repr(e) }
+                else:
+                    _store(cache, keys[futures[future]], result)
+                    yield result
+        jobs = broken
+
+def _context():
+    # fork where possible so that workers do not import microbit_stub again
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+def _init_worker(memory_limit):
+    if resource is not None and memory_limit is not None:
+        hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+        if hard != resource.RLIM_INFINITY:
+            memory_limit = min(memory_limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard))
+
+    if hasattr(signal, 'SIGXCPU'):
+        signal.signal(signal.SIGXCPU, _cpu_exhausted)
+
+class _CpuLimit:
+    # the CPU time limit of the current run
+    expired = False
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __enter__(self):
+        _CpuLimit.expired = False
+        self.__start = _cpu_time()
+        if resource is not None and self.seconds is not None:
+            soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+            # the limit is for the process, so it is from the time used
+            limit = int(self.__start + self.seconds) + 1
+            if hard == resource.RLIM_INFINITY or limit < hard:
+                resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cpu_time = _cpu_time() - self.__start
+        if resource is not None and self.seconds is not None:
+            hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+            resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+
+def _cpu_time():
+    return time.process_time()
+
+def _cpu_exhausted(signum, frame):
+    _CpuLimit.expired = True
+    raise microbit_stub.BudgetExhausted('CPU time limit exhausted',
+                                        microbit_stub.state.progress())
+
+def _run(program, scenario, options, code=None):
+    # runs one program (or its compiled code) against one scenario in a
+    # worker process
+    result = { 'program': program, 'scenario': scenario }
+    output = io.StringIO()
+
+    with contextlib.ExitStack() as stack:
+        state_file = microbit_stub.STATE_FILE_DEFAULT
+        if options['state_backend'] != 'memory':
+            directory = stack.enter_context(tempfile.TemporaryDirectory())
+            state_file = os.path.join(directory, state_file)
+
+        try:
+            device = microbit_stub.Device(state_file,
+                            options['state_backend'],
+                            clock=microbit_stub.Clock(options['time_mode']),
+                            display_sink='frames')
+            if scenario is not None:
+                device.state.play(scenario)
+        except Exception as e:
+            # e.g. a scenario file that cannot be read
+            result.update({ 'status': 'error', 'error': repr(e) })
+            return result
+
+        with _CpuLimit(options['cpu_limit']) as limit:
+            with contextlib.redirect_stdout(output):
+                report = device.run_program(
+                                _main(program, code) if code is not None
+                                else os.path.abspath(program),
+                                options['ms'], options['sleeps'],
+                                options['frames'])
+        if limit.expired:
+            report['status'] = 'cpu'
+
+        result.update(report)
+        result['images'] = [[time_ms, repr(image)] for time_ms, image 
+                            in device.display.sink.frames]
+        result['output'] = output.getvalue()
+        result['state'] = device.state.snapshot()
+        result['cpu_time'] = round(limit.cpu_time, 6)
+
+    return result
+
+def _main(program, code):
+    # a function that runs the compiled code of a program as __main__
+    def run():
+        exec(code, { '__name__': '__main__', '__file__': program,
+                        '__builtins__': __builtins__ })
+    return run
+
+def fork_grade(program, scenarios=(None,), workers=None,
+                time_mode=TIME_MODE_DEFAULT, ms=MS_DEFAULT, sleeps=None,
+                frames=None, cpu_limit=CPU_LIMIT_DEFAULT,
+                memory_limit=MEMORY_LIMIT_DEFAULT,
+                state_backend=STATE_BACKEND_DEFAULT, cache=None):
+    """Runs a program against each scenario in a forked child process and
+    yields the result of each run as it finishes (see grade).
+
+    The program is compiled once, in this process, which has already 
+    imported microbit_stub. Each child is forked from this process, so it
+    starts with the program compiled and microbit_stub imported, and runs 
+    the program with a new device. At most workers children run at once. 
+    The status of a run whose child died is 'crashed'. Where processes 
+    cannot be forked, the runs are made by grade. Results are cached as 
+    for grade.
+    """
+    options = { 'time_mode': time_mode, 'ms': ms, 'sleeps': sleeps,
+                'frames': frames, 'cpu_limit': cpu_limit,
+                'state_backend': state_backend }
+    if not hasattr(os, 'fork'):
+        yield from grade([program], scenarios, workers, memory_limit=
+                            memory_limit, cache=cache, **options)
+        return
+    
+    pending = []
+    keys = {}
+    for scenario in scenarios:
+        key, result = _cached(cache, program, scenario, options, 
+                                memory_limit)
+        if result is not None:
+            yield result
+        else:
+            pending.append(scenario)
+            keys[scenario] = key
+    if not pending:
+        return
+    
+    try:
+        with open(program) as f:
+            code = compile(f.read(), program, 'exec')
+    except (OSError, SyntaxError, ValueError) as e:
+        for scenario in pending:
+            yield { 'program': program, 'scenario': scenario, 
+                    'status': 'error', 'error': repr(e) }
+        return
+    
+    running = {}
+    workers = workers or os.cpu_count() or 1
+    
+    with selectors.DefaultSelector() as selector:
+        while pending or running:
+            while pending and len(running) < workers:
+                scenario = pending.pop(0)
+                r, w = os.pipe()
+                sys.stdout.flush()
+                pid = os.fork()
+                if pid == 0:
+                    _fork_child(r, w, program, scenario, options, code, 
+                                memory_limit)
+                os.close(w)
+                running[r] = (pid, scenario, [])
+                selector.register(r, selectors.EVENT_READ)
+                
+            # read results as they are written, so children never block
+            for key, events in selector.select():
+                pid, scenario, chunks = running[key.fd]
+                chunk = os.read(key.fd, 65536)
+                if chunk:
+                    chunks.append(chunk)
+                    continue
+                
+                selector.unregister(key.fd)
+                os.close(key.fd)
+                del running[key.fd]
+                os.waitpid(pid, 0)
+                data = b''.join(chunks)
+                if data:
+                    result = json.loads(data)
+                    _store(cache, keys[scenario], result)
+                    yield result
+                else:
+                    yield { 'program': program, 'scenario': scenario, 
+                            'status': 'crashed' }
+
+def _fork_child(r, w, program, scenario, options, code, memory_limit):
+    # runs in a forked child: writes the result of the run and exits
+    try:
+        os.close(r)
+        _init_worker(memory_limit)
+        try:
+            result = _run(program, scenario, options, code)
+        except Exception as e:
+            result = { 'program': program, 'scenario': scenario, 
+                        'status': 'error', 'error': repr(e) }
+        with os.fdopen(w, 'wb') as f:
+            f.write(json.dumps(result).encode())
+    finally:
+        os._exit(0)
+
+class ResultCache:
+    """A content-addressed cache of run results in a directory.
+    
+    A result is keyed on a hash of the program source, the scenario file
+    contents, the microbit_stub version (a hash of its source), the run
+    options (time mode, budget, memory limit etc.) and the microbit_stub 
+    settings (from microbit_stub_settings and MICROBIT_STUB_* environment
+    variables, including the contents of a scenario_file), so 
+    byte-identical runs return their cached result (with the program and 
+    scenario names of the lookup) without executing. Each result is 
+    stored as a json file named by its key. When the files total more than
+    max_size bytes, the least recently used results are evicted.
+    """
+    __SUFFIX = '.json'
+    
+    def __init__(self, directory, max_size=CACHE_SIZE_DEFAULT):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        self.__stats = { 'hits': 0, 'misses': 0, 'stores': 0, 
+                            'evictions': 0 }
+        self.__version = None
+        
+        # sizes of cached results, least recently used first
+        entries = []
+        for name in os.listdir(directory):
+            if name.endswith(ResultCache.__SUFFIX):
+                st = os.stat(os.path.join(directory, name))
+                key = name[:-len(ResultCache.__SUFFIX)]
+                entries.append((st.st_mtime_ns, key, st.st_size))
+        self.__sizes = { key:size for mtime, key, size in sorted(entries) }
+        self.__size = sum(self.__sizes.values())
+        
+    def __path(self, key):
+        return os.path.join(self.directory, key + ResultCache.__SUFFIX)
+    
+    def __digest(filename):
+        if filename is None:
+            return ''
+        with open(filename, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+        
+    def key(self, program, scenario, options):
+        """Returns the key of a run of the program against the scenario 
+        with the options.
+        """
+        if self.__version is None:
+            self.__version = ResultCache.__digest(microbit_stub.__file__)
+        
+        settings = { name:getattr(microbit_stub, name, None) 
+                        for name in microbit_stub._setting_names }
+        try:
+            scenario_file = ResultCache.__digest(settings['scenario_file'])
+        except (KeyError, OSError):
+            scenario_file = ''
+        
+        parts = [ResultCache.__digest(program), 
+                    ResultCache.__digest(scenario), self.__version, 
+                    json.dumps(options, sort_keys=True), 
+                    json.dumps(settings, sort_keys=True, default=repr),
+                    scenario_file]
+        return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+    
+    def get(self, key):
+        """Returns the cached result for the key, or None.
+        """
+        try:
+            with open(self.__path(key)) as f:
+                result = json.load(f)
+            os.utime(self.__path(key))
+        except (OSError, ValueError):
+            self.__stats['misses'] += 1
+            return None
+        
+        self.__stats['hits'] += 1
+        self.__sizes[key] = self.__sizes.pop(key, 0)
+        return result
+    
+    def put(self, key, result):
+        """Stores the result for the key, evicting the least recently used
+        results if the cache is too big.
+        """
+        data = json.dumps(result).encode()
+        path = self.__path(key)
+        temp = path + '.tmp'
+        try:
+            with open(temp, 'wb') as f:
+                f.write(data)
+            os.replace(temp, path)
+        except OSError:
+            return
+        
+        self.__stats['stores'] += 1
+        self.__size += len(data) - self.__sizes.pop(key, 0)
+        self.__sizes[key] = len(data)
+        
+        while self.__size > self.max_size and len(self.__sizes) > 1:
+            oldest = next(iter(self.__sizes))
+            self.__size -= self.__sizes.pop(oldest)
+            self.__stats['evictions'] += 1
+            with contextlib.suppress(OSError):
+                os.remove(self.__path(oldest))
+                
+    def size(self):
+        """Returns the total size in bytes of the cached results.
+        """
+        return self.__size
+                
+    def stats(self):
+        """Returns a dictionary of cache counters: hits, misses, stores and 
+        evictions.
+        """
+        return dict(self.__stats)
+    
+def _cached(cache, program, scenario, options, memory_limit):
+    # the cache key of a run and its cached result (None if not cached)
+    if cache is None:
+        return None, None
+    try:
+        key = cache.key(program, scenario, 
+                        dict(options, memory_limit=memory_limit))
+    except OSError:
+        return None, None
+    
+    result = cache.get(key)
+    if result is not None:
+        result.update({ 'program': program, 'scenario': scenario, 
+                        'cached': True })
+    return key, result
+
+def _store(cache, key, result):
+    # runs that used their CPU time may not do so again, so are not cached
+    if cache is not None and key is not None and result['status'] != 'cpu':
+        cache.put(key, result)
+
+def programs_in(directory):
+    """Returns the names of the Python files in the directory, in order.
+    """
+    return [os.path.join(directory, name)
+            for name in sorted(os.listdir(directory))
+            if name.endswith('.py')]
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='python -m microbit_stub_grade',
+                description='Run microbit programs against input scenarios '
+                            'and write a json line for each run.')
+    parser.add_argument('programs',
+                        help='a directory of programs (or a program file)')
+    parser.add_argument('scenarios', nargs='*',
+                        help='scenario files (no input events if none)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='the number of worker processes')
+    parser.add_argument('--time-mode', default=TIME_MODE_DEFAULT,
+                        choices=microbit_stub.Clock.MODES)
+    parser.add_argument('--ms', type=int, default=MS_DEFAULT,
+                        help='the running time budget of a run')
+    parser.add_argument('--sleeps', type=int, default=None,
+                        help='the sleep budget of a run')
+    parser.add_argument('--frames', type=int, default=None,
+                        help='the display update budget of a run')
+    parser.add_argument('--cpu-limit', type=float, default=CPU_LIMIT_DEFAULT,
+                        help='the CPU time limit of a run in seconds')
+    parser.add_argument('--memory-limit', type=int,
+                        default=MEMORY_LIMIT_DEFAULT,
+                        help='the memory limit of a worker in bytes')
+    parser.add_argument('--state-backend', default=STATE_BACKEND_DEFAULT,
+                        choices=sorted(microbit_stub.STATE_BACKENDS))
+    parser.add_argument('--output', default=None,
+                        help='the file for results (default stdout)')
+    parser.add_argument('--cache', default=None,
+                        help='a directory of cached results')
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE_DEFAULT,
+                        help='the maximum size of the cache in bytes')
+    parser.add_argument('--fork-server', action='store_true',
+                        help='compile each program once and fork a process '
+                                'for each run of it')
+    options = parser.parse_args(args)
+
+    programs = programs_in(options.programs) \
+                if os.path.isdir(options.programs) else [options.programs]
+
+    with contextlib.ExitStack() as stack:
+        out = sys.stdout if options.output is None \
+                else stack.enter_context(open(options.output, 'w'))
+
+        scenarios = options.scenarios or [None]
+        cache = ResultCache(options.cache, options.cache_size) \
+                if options.cache is not None else None
+        settings = (options.workers, options.time_mode, options.ms,
+                    options.sleeps, options.frames, options.cpu_limit,
+                    options.memory_limit, options.state_backend, cache)
+        if options.fork_server:
+            results = (result for program in programs 
+                        for result in fork_grade(program, scenarios, 
+                                                    *settings))
+        else:
+            results = grade(programs, scenarios, *settings)
+            
+        for result in results:
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+            
+    if cache is not None:
+        print('cache:', json.dumps(cache.stats()), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,59 @@
+# settings can be overridden by MICROBIT_STUB_<NAME> environment variables,
+# e.g. MICROBIT_STUB_STATE_BACKEND=memory
+
 # the name of the initial json file to read microbit state
 state_file = 'microbit_state.json'
 
+# 'json' to store state in the json state file, 'memory' to store state in
+# memory only, 'mmap' to store state in a memory-mapped binary file next to
+# the json state file, 'shm' to store state in a named shared memory block,
+# 'sqlite' to store state in an SQLite database next to the json state file or
+# 'journal' to append state changes to a journal next to the json state file
+state_backend = 'json'
+
+# if True, the json state file is watched (with inotify on Linux, otherwise
+# by polling) and only loaded after it has been written
+state_watch = False
+
+# the size in bytes of journal records after which the journal is compacted
+journal_max_size = 65536
+
+# if True, state changes are held in memory and written to the state file on
+# sleep, reset, exit or when older than write_behind_latency milliseconds
+write_behind = False
+write_behind_latency = 100
+
+# 'real' for sleep to block for the time slept, 'virtual' for sleep to only
+# advance the running time, so that programs run as fast as possible, or
+# 'scheduled' for virtual time in which idle loops skip to the next state
+# change scheduled with state.schedule or stop the program if there is none
+time_mode = 'real'
+
+# the number of consecutive idle sleeps after which a program is idle in
+# 'scheduled' time_mode
+idle_sleeps = 3
+
+# the speed of the microbit relative to real time in 'real' time_mode, e.g. 10
+# for sleep to block for a tenth of the time slept or 0.5 to block for twice it
+time_scale = 1.0
+
+# if True, running_time() returns the real time (multiplied by time_scale)
+# since power on in 'real' time_mode, rather than the total of sleeps
+monotonic_running_time = False
+
+# the name of a scenario file of input events to play, with one json
+# [time_ms, key, value] event per line in time order, or '' for no scenario,
+# and whether to stream the file rather than read it all on start up
+scenario_file = ''
+scenario_stream = False
+
+# 'text' to print display frames, 'null' to discard them or 'frames' to keep
+# them in memory (see the display sink classes)
+display_sink = 'text'
+
+# the number of characters of display frames that the 'text' sink holds in a
+# buffer before writing them in one write, or 0 to print each frame, and the
+# milliseconds after which buffered frames are written (they are also written
+# on sleep and at exit)
+display_buffer_size = 0
+display_buffer_latency = 100
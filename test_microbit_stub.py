@@ -28,12 +28,33 @@ Nick Cook, School of Computing Science, Newcastle University
 ------------------------------------------------------------------------------
 """
 import array
+import asyncio
+import contextlib
 import doctest
+import gc
+import io
+import json
+import multiprocessing
+import os
 import random
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import weakref
 
 from microbit_stub import *
-from microbit_stub import Button, Pin, STATE_FILE_DEFAULT, State
+import microbit_stub
+import microbit_stub_grade
+from microbit_stub import BudgetExhausted, Button, Clock, Device, \
+        EmulationStopped, JournalBackend, JsonFileBackend, \
+        MappedFileBackend, \
+        MemoryBackend, NullSink, Pin, RecorderSink, Scenario, Scheduler, \
+        SharedMemoryBackend, TextSink, \
+        SqliteBackend, compile_program, \
+        STATE_FILE_DEFAULT, State, StateBackend, StateFileWatcher, _setting, \
+        run_program, sleep_async
 
 def init(full_init):
     print()
@@ -204,6 +225,784 @@ class TestState(unittest.TestCase):
         self.assertEqual(state.get('state_file'), STATE_FILE_DEFAULT)
 
 
+""" ---------------------------------------------------------------------- """    
+""" state backend tests -------------------------------------------------- """
+class TestStateBackend(unittest.TestCase):
+    def setUp(self):
+        init(False)
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, STATE_FILE_DEFAULT)
+        
+    def tearDown(self):
+        self.dir.cleanup()
+        
+    def test_memory(self):
+        memory = State(self.filename, 'memory')
+        version = memory._State__backend.version()
+        memory.set('pin0', 1)
+        memory.press('button_a')
+        self.assertEqual(memory.get('pin0'), 1)
+        self.assertEqual(memory.get('button_a_presses'), 1)
+        self.assertNotEqual(memory._State__backend.version(), version)
+        memory.reset()
+        self.assertEqual(memory.get('pin0'), 0)
+        self.assertEqual(memory.get('power'), 1)
+        self.assertEqual(memory.get('state_file'), self.filename)
+        self.assertFalse(os.path.exists(self.filename))
+        
+    def test_backend_class(self):
+        class Backend(MemoryBackend):
+            pass
+            
+        custom = State(self.filename, Backend)
+        self.assertIsInstance(custom._State__backend, Backend)
+        custom.set('pin0', 1)
+        self.assertEqual(custom.get('pin0'), 1)
+        
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            State(self.filename, 'unknown')
+            
+    def test_backend_fallback(self):
+        class Backend(StateBackend):
+            def __init__(self, data):
+                raise OSError('unavailable')
+                
+        with self.assertWarns(RuntimeWarning):
+            fallback = State(self.filename, Backend)
+        self.assertIsInstance(fallback._State__backend, JsonFileBackend)
+        
+    def test_backend_fallback_options(self):
+        filename = os.path.join(self.dir.name, 'missing', STATE_FILE_DEFAULT)
+        with self.assertWarns(RuntimeWarning):
+            fallback = State(filename, 'journal', journal_max_size=10)
+        self.assertIsInstance(fallback._State__backend, JsonFileBackend)
+        fallback.set('pin0', 1)
+        self.assertEqual(fallback.get('pin0'), 1)
+        
+    def test_setting_from_environment(self):
+        os.environ['MICROBIT_STUB_STATE_BACKEND'] = 'memory'
+        os.environ['MICROBIT_STUB_WRITE_BEHIND'] = 'true'
+        os.environ['MICROBIT_STUB_WRITE_BEHIND_LATENCY'] = '20'
+        os.environ['MICROBIT_STUB_TIME_SCALE'] = '2.5'
+        try:
+            self.assertEqual(_setting('state_backend', 'json'), 'memory')
+            self.assertIs(_setting('write_behind', False), True)
+            self.assertEqual(_setting('write_behind_latency', 100), 20)
+            self.assertEqual(_setting('time_scale', 1.0), 2.5)
+        finally:
+            del os.environ['MICROBIT_STUB_STATE_BACKEND']
+            del os.environ['MICROBIT_STUB_WRITE_BEHIND']
+            del os.environ['MICROBIT_STUB_WRITE_BEHIND_LATENCY']
+            del os.environ['MICROBIT_STUB_TIME_SCALE']
+            
+        self.assertEqual(_setting('state_backend', 'json'), 'json')
+        self.assertEqual(_setting('unknown', 'default'), 'default')
+
+
+""" ---------------------------------------------------------------------- """    
+""" write-behind tests --------------------------------------------------- """
+class TestWriteBehind(unittest.TestCase):
+    def setUp(self):
+        init(False)
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, STATE_FILE_DEFAULT)
+        self.state = State(self.filename, write_behind=True,
+                            write_behind_latency=None)
+        self.state.reset()
+        
+    def tearDown(self):
+        self.dir.cleanup()
+        
+    def read_state_file(self):
+        with open(self.filename) as f:
+            return json.load(f)
+        
+    def test_set_is_held_back(self):
+        flushes = self.state.stats()['flushes']
+        
+        for i in range(1, 1000):
+            self.state.set('pin0', i % 2)
+            
+        self.assertEqual(self.state.get('pin0'), 1)
+        self.assertEqual(self.read_state_file()['pin0'], 0)
+        self.assertEqual(self.state.stats()['flushes'], flushes)
+        
+        self.state.flush()
+        self.assertEqual(self.read_state_file()['pin0'], 1)
+        self.assertEqual(self.state.stats()['flushes'], flushes + 1)
+        
+        self.state.flush()
+        self.assertEqual(self.state.stats()['flushes'], flushes + 1)
+        
+    def test_flush_merges_external_changes(self):
+        other = State(self.filename)
+        self.state.set('pin1', 1)
+        other.set('pin2', 1)
+        self.state.flush()
+        
+        data = self.read_state_file()
+        self.assertEqual(data['pin1'], 1)
+        self.assertEqual(data['pin2'], 1)
+        
+    def test_load_keeps_held_back_changes(self):
+        self.state.set('pin3', 1)
+        self.state.load()
+        self.assertEqual(self.state.get('pin3'), 1)
+        
+    def test_reset_discards_held_back_changes(self):
+        self.state.set('pin4', 1)
+        self.state.reset()
+        self.state.flush()
+        self.assertEqual(self.state.get('pin4'), 0)
+        self.assertEqual(self.read_state_file()['pin4'], 0)
+        
+    def test_flushed_at_exit(self):
+        self.state.set('pin6', 1)
+        microbit_stub._flush_at_exit()
+        self.assertEqual(self.read_state_file()['pin6'], 1)
+        
+    def test_not_kept_alive(self):
+        backends = [weakref.ref(State(self.filename, write_behind=True, 
+                        write_behind_latency=None)._State__backend) 
+                    for i in range(20)]
+        gc.collect()
+        self.assertEqual([b for b in backends if b() is not None], [])
+        
+    def test_latency(self):
+        latent = State(self.filename, write_behind=True,
+                        write_behind_latency=10)
+        latent.set('pin5', 1)
+        time.sleep(0.5)
+        self.assertEqual(self.read_state_file()['pin5'], 1)
+
+
+""" ---------------------------------------------------------------------- """    
+""" load change detection tests ------------------------------------------ """
+class TestLoadChangeDetection(unittest.TestCase):
+    def setUp(self):
+        init(False)
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, STATE_FILE_DEFAULT)
+        self.state = State(self.filename)
+        self.state.reset()
+        time.sleep(JsonFileBackend._JsonFileBackend__RACY_NS / 1e9)
+        
+    def tearDown(self):
+        self.dir.cleanup()
+        
+    def test_unchanged_file_not_parsed(self):
+        self.state.load()
+        stats = self.state.stats()
+        
+        for i in range(100):
+            self.state.load()
+            
+        self.assertEqual(self.state.stats()['load_hits'], 
+                            stats['load_hits'] + 100)
+        self.assertEqual(self.state.stats()['load_misses'], 
+                            stats['load_misses'])
+        
+    def test_unchanged_file_restores_state(self):
+        self.state.load()
+        self.state._State__data['pin0'] = 1
+        self.state.load()
+        self.assertEqual(self.state.get('pin0'), 0)
+        
+    def test_changed_file_parsed(self):
+        self.state.load()
+        misses = self.state.stats()['load_misses']
+        
+        State(self.filename).set('pin0', 1)
+        self.state.load()
+        self.assertEqual(self.state.get('pin0'), 1)
+        self.assertEqual(self.state.stats()['load_misses'], misses + 1)
+        
+        State(self.filename).set('pin0', 0)
+        self.state.load()
+        self.assertEqual(self.state.get('pin0'), 0)
+        self.assertEqual(self.state.stats()['load_misses'], misses + 2)
+        
+    def test_own_writes_not_parsed(self):
+        stats = self.state.stats()
+        
+        for i in range(100):
+            self.state.set('pin0', i % 2)
+            
+        self.assertEqual(self.state.stats()['load_misses'], 
+                            stats['load_misses'])
+        self.assertEqual(self.state.stats()['load_hits'], 
+                            stats['load_hits'] + 100)
+        self.assertEqual(State(self.filename).get('pin0'), 1)
+        
+    def test_recent_change_of_same_size_parsed(self):
+        self.state.set('pin0', 1)
+        with open(self.filename) as f:
+            text = f.read()
+        with open(self.filename, 'w') as f:
+            f.write(text.replace('"pin0": 1', '"pin0": 2'))
+        self.state.load()
+        self.assertEqual(self.state.get('pin0'), 2)
+        
+    def test_chain_preloaded(self):
+        names = [os.path.join(self.dir.name, 'microbit_state_0{0}.json'
+                                .format(i)) for i in range(3)]
+        for i, name in enumerate(names):
+            with open(name, 'w') as f:
+                json.dump({ 'button_a':i % 2, 'pin0':i,
+                            'state_file':names[(i + 1) % 3] }, f)
+        time.sleep(JsonFileBackend._JsonFileBackend__RACY_NS / 1e9)
+        
+        chained = State(names[0])
+        self.assertEqual(chained.stats()['preloaded'], 3)
+        misses = chained.stats()['load_misses']
+        
+        for i in range(1, 10):
+            chained.load()
+            self.assertEqual(chained.get('pin0'), i % 3)
+        self.assertEqual(chained.stats()['load_misses'], misses)
+        
+        with open(names[1], 'w') as f:
+            json.dump({ 'pin0':10, 'state_file':names[2] }, f)
+        chained.load()
+        self.assertEqual(chained.get('pin0'), 10)
+        self.assertEqual(chained.stats()['load_misses'], misses + 1)
+
+
+""" ---------------------------------------------------------------------- """    
+""" state watch tests ---------------------------------------------------- """
+class TestStateWatch(unittest.TestCase):
+    def setUp(self):
+        init(False)
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, STATE_FILE_DEFAULT)
+        State(self.filename).reset()
+        self.state = State(self.filename, watch=True)
+        self.state.load()
+        
+    def tearDown(self):
+        self.dir.cleanup()
+        
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'requires Linux')
+    def test_inotify_used_on_linux(self):
+        self.assertTrue(StateFileWatcher().inotify)
+        
+    def test_unchanged_file_not_loaded(self):
+        stats = self.state.stats()
+        
+        for i in range(100):
+            self.state.load()
+            
+        self.assertEqual(self.state.stats()['load_hits'], 
+                            stats['load_hits'] + 100)
+        self.assertEqual(self.state.stats()['load_misses'], 
+                            stats['load_misses'])
+        
+    def test_own_writes_not_parsed(self):
+        stats = self.state.stats()
+        
+        for i in range(100):
+            self.state.set('pin0', i % 2)
+            self.state.load()
+            
+        self.assertEqual(self.state.stats()['load_misses'], 
+                            stats['load_misses'])
+        
+    def test_written_file_loaded(self):
+        other = State(self.filename)
+        
+        for value in [1, 0, 1]:
+            other.set('pin0', value)
+            self.state.load()
+            self.assertEqual(self.state.get('pin0'), value)
+            
+    @unittest.skipUnless(StateFileWatcher().inotify, 'requires inotify')
+    def test_get_sees_written_file(self):
+        State(self.filename).set('pin0', 1)
+        self.assertEqual(self.state.get('pin0'), 1)
+        
+    def test_next_state_file_watched(self):
+        filename = os.path.join(self.dir.name, 'next.json')
+        with open(filename, 'w') as f:
+            json.dump({'pin0': 1, 'state_file': filename}, f)
+        with open(self.filename, 'w') as f:
+            json.dump({'pin0': 0, 'state_file': filename}, f)
+        self.state.load()
+        self.state.load()
+        self.assertEqual(self.state.get('pin0'), 1)
+        
+        with open(filename, 'w') as f:
+            json.dump({'pin0': 2, 'state_file': filename}, f)
+        self.state.load()
+        self.assertEqual(self.state.get('pin0'), 2)
+        
+    def test_polling_fallback(self):
+        watcher = StateFileWatcher(False)
+        self.assertFalse(watcher.inotify)
+        watcher.watch([self.filename])
+        watcher.clean()
+        time.sleep(StateFileWatcher._StateFileWatcher__RACY_NS / 1e9)
+        watcher.clean()
+        self.assertFalse(watcher.dirty())
+        
+        State(self.filename).set('pin0', 1)
+        self.assertTrue(watcher.dirty())
+        watcher.close()
+
+
+""" ---------------------------------------------------------------------- """    
+""" state subscription tests --------------------------------------------- """
+class TestStateSubscribe(unittest.TestCase):
+    def setUp(self):
+        init(False)
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, STATE_FILE_DEFAULT)
+        self.state = State(self.filename)
+        self.state.reset()
+        
+    def tearDown(self):
+        self.dir.cleanup()
+        
+    def test_callback_batched_on_flush(self):
+        batches = []
+        self.state.subscribe(['pin0', 'power'], batches.append)
+        self.state.set('pin0', 1)
+        self.state.set('pin1', 1)
+        self.state.power_off()
+        self.assertEqual(batches, [])
+        
+        self.state.flush()
+        self.assertEqual(batches, [[('pin0', 1), ('power', 0)]])
+        
+        self.state.flush()
+        self.assertEqual(len(batches), 1)
+        
+    def test_short_pulse_delivered(self):
+        batches = []
+        self.state.subscribe('pin0', batches.append)
+        self.state.set('pin0', 1)
+        self.state.set('pin0', 0)
+        self.state.flush()
+        self.assertEqual(batches, [[('pin0', 1), ('pin0', 0)]])
+        
+    def test_press_counter_delivered(self):
+        batches = []
+        self.state.subscribe(['button_a', 'button_a_presses'], batches.append)
+        self.state.press('button_a')
+        self.state.flush()
+        self.assertEqual(batches, [[('button_a', 1), 
+                                    ('button_a_presses', 1)]])
+    
+    def test_loaded_changes_delivered(self):
+        subscriber = self.state.subscribe(['pin0'])
+        other = State(self.filename)
+        other.set('pin0', 5)
+        other.set('pin1', 5)
+        self.state.load()
+        self.assertEqual(subscriber.get_nowait(), [('pin0', 5)])
+        self.assertTrue(subscriber.empty())
+        
+    def test_unsubscribe(self):
+        batches = []
+        self.state.subscribe(None, batches.append)
+        self.state.unsubscribe(batches.append)
+        self.state.set('pin0', 1)
+        self.state.flush()
+        self.assertEqual(batches, [])
+        
+    def test_unknown_key(self):
+        with self.assertRaises(ValueError):
+            self.state.subscribe(['pin99'])
+
+
+""" ---------------------------------------------------------------------- """    
+""" state update and transaction tests ----------------------------------- """
+class TestStateTransaction(unittest.TestCase):
+    def setUp(self):
+        init(False)
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, STATE_FILE_DEFAULT)
+        self.state = State(self.filename)
+        self.state.reset()
+        
+    def tearDown(self):
+        self.dir.cleanup()
+        
+    def test_update_single_dump(self):
+        changes = { 'pin' + str(i):1 for i in range(17) }
+        changes.update({ 'accelerometer_x':-10, 'accelerometer_y':10,
+                            'accelerometer_z':1000, 'button_a':1 })
+        flushes = self.state.stats()['flushes']
+        self.state.update(changes)
+        self.assertEqual(self.state.stats()['flushes'], flushes + 1)
+        
+        other = State(self.filename)
+        other.load()
+        for k, v in changes.items():
+            self.assertEqual(other.get(k), v)
+            
+    def test_update_invalid_changes_nothing(self):
+        with self.assertRaises(ValueError):
+            self.state.update({ 'pin0':1, 'pin1':1024 })
+        self.assertEqual(self.state.get('pin0'), 0)
+        
+    def test_transaction_single_dump(self):
+        flushes = self.state.stats()['flushes']
+        with self.state.transaction():
+            self.state.set('pin0', 1)
+            self.state.press('button_a')
+            self.assertEqual(self.state.get('pin0'), 1)
+            self.assertEqual(self.state.get('button_a_presses'), 1)
+            self.assertEqual(self.state.stats()['flushes'], flushes)
+            
+        self.assertEqual(self.state.stats()['flushes'], flushes + 1)
+        self.state.load()
+        self.assertEqual(self.state.get('pin0'), 1)
+        self.assertEqual(self.state.get('button_a'), 1)
+        self.assertEqual(self.state.get('button_a_presses'), 1)
+        
+    def test_transaction_exception_changes_nothing(self):
+        with self.assertRaises(ValueError):
+            with self.state.transaction():
+                self.state.set('pin0', 1)
+                self.state.set('pin1', -1)
+        self.assertEqual(self.state.get('pin0'), 0)
+        self.assertEqual(self.state.get('pin1'), 0)
+        
+    def test_transaction_reset(self):
+        self.state.set('pin0', 1)
+        with self.state.transaction():
+            self.state.reset()
+            self.state.set('pin1', 1)
+        self.assertEqual(self.state.get('pin0'), 0)
+        self.assertEqual(self.state.get('pin1'), 1)
+        self.assertEqual(self.state.get('power'), 1)
+        self.assertEqual(self.state.get('state_file'), self.filename)
+
+
+""" ---------------------------------------------------------------------- """    
+""" memory-mapped state tests -------------------------------------------- """
+class TestMappedState(unittest.TestCase):
+    def setUp(self):
+        init(False)
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, STATE_FILE_DEFAULT)
+        self.state = State(self.filename, 'mmap')
+        self.state.reset()
+        
+    def tearDown(self):
+        self.dir.cleanup()
+        
+    def write_json(self, name, data):
+        filename = os.path.join(self.dir.name, name)
+        with open(filename, 'w') as f:
+            json.dump(data, f)
+        return filename
+        
+    def test_get_set(self):
+        self.assertTrue(os.path.exists(MappedFileBackend.path(self.filename)))
+        self.assertEqual(self.state.get('pin0'), 0)
+        self.state.set('pin0', 1023)
+        self.assertEqual(self.state.get('pin0'), 1023)
+        self.state.set('accelerometer_x', -1024)
+        self.assertEqual(self.state.get('accelerometer_x'), -1024)
+        self.assertEqual(self.state.get('unknown'), 0)
+        
+        with self.assertRaises(ValueError):
+            self.state.set('pin0', 1024)
+        
+    def test_shared_between_states(self):
+        other = State(self.filename, 'mmap')
+        other.press('button_a')
+        self.assertTrue(self.state.get('button_a'))
+        self.assertEqual(self.state.get('button_a_presses'), 1)
+        self.state.reset()
+        self.assertEqual(other.get('button_a_presses'), 0)
+        self.assertEqual(other.get('power'), 1)
+        
+    def test_created_from_json(self):
+        filename = self.write_json('created.json', { 'pin1': 7 })
+        created = State(filename, 'mmap')
+        self.assertEqual(created.get('pin1'), 7)
+        self.assertEqual(created.get('power'), 1)
+        self.assertEqual(created.get('state_file'), filename)
+        
+    def test_state_file_chain(self):
+        filename_01 = os.path.join(self.dir.name, 'state_01.json')
+        filename_00 = self.write_json('state_00.json',
+                            { 'button_a': 0, 'state_file': filename_01 })
+        self.write_json('state_01.json', 
+                            { 'button_a': 1, 'state_file': filename_00 })
+        
+        chained = State(filename_00, 'mmap')
+        for value in [0, 1, 0, 1]:
+            self.assertEqual(chained.get('button_a'), value)
+            chained.load()
+            
+    def test_interrupted_change(self):
+        # a writer that stopped part way through leaves the version odd
+        backend = self.state._State__backend
+        backend._MappedFileBackend__set_version(backend.version() | 1)
+        self.assertEqual(backend.snapshot()['pin0'], 0)
+        self.assertEqual(backend.version() % 2, 0)
+        
+        backend._MappedFileBackend__set_version(backend.version() + 1)
+        self.state.set('pin0', 5)
+        self.assertEqual(backend.version() % 2, 0)
+        self.assertEqual(backend.snapshot()['pin0'], 5)
+        
+    def test_concurrent_writers(self):
+        backends = [State(self.filename, 'mmap')._State__backend 
+                        for i in range(2)]
+        
+        def write(backend, offset):
+            for i in range(1000):
+                value = (i * 2 + offset) % 1024
+                backend.batch({ 'pin0': value, 'pin1': value })
+                
+        writers = [threading.Thread(target=write, args=(backend, offset)) 
+                        for offset, backend in enumerate(backends)]
+        for writer in writers:
+            writer.start()
+        while any(writer.is_alive() for writer in writers):
+            snapshot = self.state._State__backend.snapshot()
+            self.assertEqual(snapshot['pin0'], snapshot['pin1'])
+        for writer in writers:
+            writer.join()
+        self.assertEqual(self.state._State__backend.version() % 2, 0)
+
+
+""" ---------------------------------------------------------------------- """    
+""" shared memory state tests -------------------------------------------- """
+def write_in_process(filename, backend, key, value):
+    State(filename, backend).set(key, value)
+
+class TestSharedMemoryState(unittest.TestCase):
+    def setUp(self):
+        init(False)
+        self.dir = tempfile.TemporaryDirectory()
+        self.filenames = [os.path.join(self.dir.name, name) 
+                    for name in [STATE_FILE_DEFAULT, 'state_00.json', 
+                                    'state_01.json']]
+        self.filename = self.filenames[0]
+        self.state = State(self.filename, 'shm')
+        self.state.reset()
+        
+    def tearDown(self):
+        from multiprocessing import shared_memory
+        
+        for filename in self.filenames:
+            try:
+                shared_memory.SharedMemory(
+                            SharedMemoryBackend.name(filename)).unlink()
+            except FileNotFoundError:
+                pass
+            
+        self.dir.cleanup()
+        
+    def test_get_set(self):
+        self.assertIsInstance(self.state._State__backend, SharedMemoryBackend)
+        self.state.set('pin0', 1023)
+        self.assertEqual(self.state.get('pin0'), 1023)
+        self.assertEqual(self.state.get('unknown'), 0)
+        self.assertEqual(self.state.get('state_file'), self.filename)
+        
+    def test_shared_between_processes(self):
+        context = multiprocessing.get_context('spawn')
+        writer = context.Process(target=write_in_process, 
+                                    args=(self.filename, 'shm', 'pin1', 7))
+        writer.start()
+        writer.join()
+        self.assertEqual(self.state.get('pin1'), 7)
+        
+    def test_consistent_snapshot(self):
+        other = State(self.filename, 'shm')
+        backend = other._State__backend
+        done = threading.Event()
+        
+        def write():
+            for i in range(2000):
+                backend.batch({ 'pin0': i % 1024, 'pin1': i % 1024 })
+            done.set()
+            
+        writer = threading.Thread(target=write)
+        writer.start()
+        while not done.is_set():
+            snapshot = self.state._State__backend.snapshot()
+            self.assertEqual(snapshot['pin0'], snapshot['pin1'])
+        writer.join()
+        
+    def test_state_file_chain(self):
+        filename_00, filename_01 = self.filenames[1:]
+        with open(filename_00, 'w') as f:
+            json.dump({ 'button_a': 0, 'state_file': filename_01 }, f)
+        with open(filename_01, 'w') as f:
+            json.dump({ 'button_a': 1, 'state_file': filename_00 }, f)
+        
+        chained = State(filename_00, 'shm')
+        for value in [0, 1, 0, 1]:
+            self.assertEqual(chained.get('button_a'), value)
+            chained.load()
+
+
+""" ---------------------------------------------------------------------- """    
+""" sqlite state tests --------------------------------------------------- """
+def press_repeatedly(filename, backend, button, n):
+    pressing = State(filename, backend)
+    for i in range(n):
+        pressing.press(button)
+        pressing.release(button)
+
+class TestSqliteState(unittest.TestCase):
+    def setUp(self):
+        init(False)
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, STATE_FILE_DEFAULT)
+        self.state = State(self.filename, 'sqlite')
+        self.state.reset()
+        
+    def tearDown(self):
+        self.dir.cleanup()
+        
+    def test_get_set(self):
+        self.assertIsInstance(self.state._State__backend, SqliteBackend)
+        self.assertTrue(os.path.exists(SqliteBackend.path(self.filename)))
+        self.state.set('pin0', 1023)
+        self.assertEqual(self.state.get('pin0'), 1023)
+        self.assertEqual(self.state.get('unknown'), 0)
+        self.assertEqual(self.state.get('state_file'), self.filename)
+        self.state.reset()
+        self.assertEqual(self.state.get('pin0'), 0)
+        self.assertEqual(self.state.get('power'), 1)
+        
+    def test_concurrent_presses(self):
+        processes = 8
+        presses = 25
+        context = multiprocessing.get_context('spawn')
+        
+        workers = [context.Process(target=press_repeatedly, 
+                        args=(self.filename, 'sqlite', 'button_a', presses))
+                    for i in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            
+        self.assertEqual(self.state.get('button_a_presses'), 
+                            processes * presses)
+        
+    def test_state_file_chain(self):
+        filename_01 = os.path.join(self.dir.name, 'state_01.json')
+        filename_00 = os.path.join(self.dir.name, 'state_00.json')
+        with open(filename_00, 'w') as f:
+            json.dump({ 'button_a': 0, 'state_file': filename_01 }, f)
+        with open(filename_01, 'w') as f:
+            json.dump({ 'button_a': 1, 'state_file': filename_00 }, f)
+        
+        chained = State(filename_00, 'sqlite')
+        for value in [0, 1, 0, 1]:
+            self.assertEqual(chained.get('button_a'), value)
+            chained.load()
+
+
+""" ---------------------------------------------------------------------- """    
+""" journal state tests -------------------------------------------------- """
+class TestJournalState(unittest.TestCase):
+    def setUp(self):
+        init(False)
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, STATE_FILE_DEFAULT)
+        self.state = State(self.filename, 'journal')
+        self.state.reset()
+        
+    def tearDown(self):
+        self.dir.cleanup()
+        
+    def read_journal(self):
+        with open(JournalBackend.path(self.filename)) as f:
+            return [json.loads(line) for line in f]
+        
+    def test_changes_appended(self):
+        size = len(self.read_journal())
+        self.state.set('pin0', 1)
+        self.state.press('button_a')
+        
+        records = self.read_journal()
+        self.assertEqual(len(records), size + 3)
+        self.assertEqual(records[-3][1:], ['pin0', 1])
+        self.assertEqual(records[-1][1:], ['button_a_presses', 1])
+        self.assertEqual([r[0] for r in records], 
+                            list(range(records[0][0], records[-1][0] + 1)))
+        
+    def test_load_replays_new_records(self):
+        other = State(self.filename, 'journal')
+        replayed = other.stats()['replayed']
+        self.state.set('pin1', 2)
+        self.state.set('pin2', 3)
+        other.load()
+        self.assertEqual(other.get('pin1'), 2)
+        self.assertEqual(other.get('pin2'), 3)
+        self.assertEqual(other.stats()['replayed'], replayed + 2)
+        
+    def test_partial_record_ignored(self):
+        other = State(self.filename, 'journal')
+        with open(JournalBackend.path(self.filename), 'a') as f:
+            f.write('[1000,"pin3",')
+        other.load()
+        self.assertEqual(other.get('pin3'), 0)
+        
+    def test_append_after_partial_record(self):
+        other = State(self.filename, 'journal')
+        with open(JournalBackend.path(self.filename), 'a') as f:
+            f.write('[1000,"pin3",')
+        self.state.set('pin2', 7)
+        other.load()
+        self.assertEqual(other.get('pin2'), 7)
+        self.assertEqual(other.get('pin3'), 0)
+        self.assertEqual(self.read_journal()[-1][1:], ['pin2', 7])
+        self.assertEqual(State(self.filename, 'journal').get('pin2'), 7)
+        
+    def test_invalid_record_skipped(self):
+        other = State(self.filename, 'journal')
+        with open(JournalBackend.path(self.filename), 'a') as f:
+            f.write('[99,"pin1",[2,"pin2",7]\n')
+        self.state.set('pin2', 7)
+        other.load()
+        self.assertEqual(other.get('pin2'), 7)
+        self.assertEqual(other.stats()['skipped'], 1)
+        
+    def test_compaction(self):
+        compacting = State(self.filename, 'journal', journal_max_size=200)
+        other = State(self.filename, 'journal')
+        
+        for i in range(20):
+            compacting.press('button_b')
+            other.press('button_b')
+            
+        self.assertGreater(compacting.stats()['compactions'], 0)
+        self.assertLess(len(self.read_journal()), 20)
+        self.assertIsNone(self.read_journal()[0][1])
+        self.state.load()
+        self.assertEqual(self.state.get('button_b_presses'), 40)
+        
+    def test_concurrent_presses(self):
+        processes = 8
+        presses = 25
+        context = multiprocessing.get_context('spawn')
+        
+        workers = [context.Process(target=press_repeatedly, 
+                        args=(self.filename, 'journal', 'button_a', presses))
+                    for i in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        
+        self.state.load()
+        self.assertEqual(self.state.get('button_a_presses'), 
+                            processes * presses)
+
+
 """ ---------------------------------------------------------------------- """    
 """ reset test ----------------------------------------------------------- """
 class TestReset(unittest.TestCase):        
@@ -286,6 +1085,961 @@ class TestRunningTime(unittest.TestCase):
         self.assertTrue(diff <= State._State__RUNTIME_MAX_INCR + delay)
         
 
+class TestVirtualClock(unittest.TestCase):
+    def setUp(self):
+        init(True)
+        self.clock = state.clock
+        state.clock = Clock('virtual')
+        
+    def tearDown(self):
+        state.clock = self.clock
+        
+    def test_sleep_does_not_block(self):
+        state.power_off()
+        start = time.monotonic()
+        
+        for i in range(100):
+            sleep(1000)
+            
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(state._State__get_runtime(), 100000)
+        
+    def test_running_time_increment(self):
+        state.power_off()
+        sleep(10)
+        self.assertEqual(running_time(), 11)
+        self.assertEqual(running_time(), 12)
+        
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            Clock('sundial')
+        
+
+class TestScaledClock(unittest.TestCase):
+    def setUp(self):
+        init(True)
+        self.clock = state.clock
+        
+    def tearDown(self):
+        state.clock = self.clock
+        
+    def test_sleep_scaled(self):
+        state.clock = Clock('real', 100)
+        state.power_off()
+        start = time.monotonic()
+        
+        for i in range(50):
+            sleep(20)
+            
+        elapsed = time.monotonic() - start
+        self.assertGreaterEqual(elapsed, 0.01)
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(state._State__get_runtime(), 1000)
+        
+    def test_drift_corrected(self):
+        clock = Clock('real', 10)
+        start = time.monotonic()
+        
+        for i in range(100):
+            clock.sleep(10)
+            time.sleep(0.0005)
+            
+        self.assertLess(time.monotonic() - start, 0.1 + 0.05)
+        
+    def test_invalid_scale(self):
+        with self.assertRaises(ValueError):
+            Clock('real', 0)
+            
+    def test_deadlines_absorb_overhead(self):
+        clock = Clock('real', 1)
+        start = time.monotonic()
+        
+        for i in range(20):
+            clock.sleep(10)
+            time.sleep(0.002)
+            
+        self.assertLess(time.monotonic() - start, 0.2 + 0.03)
+        
+    def test_lag_restarts_deadlines(self):
+        clock = Clock('real', 1)
+        clock.sleep(10)
+        time.sleep(0.2)
+        clock.sleep(10)
+        self.assertEqual(clock.stats()['lagged'], 1)
+        
+        start = time.monotonic()
+        clock.sleep(50)
+        self.assertGreaterEqual(time.monotonic() - start, 0.045)
+        
+    def test_overshoot_histogram(self):
+        clock = Clock('real', 10)
+        
+        for i in range(10):
+            clock.sleep(10)
+            
+        stats = clock.stats()
+        self.assertEqual(stats['sleeps'], 10)
+        self.assertEqual(sum(stats['overshoot_us'].values()), 10)
+        self.assertLessEqual(stats['max_overshoot_us'], 
+                                max(stats['overshoot_us']))
+        
+    def test_monotonic_running_time(self):
+        state.clock = Clock('real', 1, True)
+        state.power_off()
+        time.sleep(0.05)
+        self.assertGreaterEqual(running_time(), 50)
+        self.assertLess(running_time(), 1000)
+        
+
+class TestScheduledClock(unittest.TestCase):
+    def setUp(self):
+        init(True)
+        self.clock = state.clock
+        state.clock = Clock('scheduled')
+        state.power_off()
+        
+    def tearDown(self):
+        state.clock = self.clock
+        
+    def run_source(self, source):
+        # runs the source as a program file and returns the report
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, 'program.py')
+            with open(filename, 'w') as f:
+                f.write('from microbit_stub import *\n' + source)
+            return run_program(filename)
+            
+    def test_idle_loop_skips_to_event(self):
+        state.schedule(60000, { 'button_a':1 })
+        report = self.run_source('while not button_a.is_pressed():\n'
+                                 '    sleep(50)\n')
+        
+        self.assertEqual(report['status'], 'finished')
+        self.assertLess(report['sleeps'], 10)
+        self.assertEqual(state._State__get_runtime(), 60000)
+        self.assertGreater(state.clock.stats()['skipped_ms'], 0)
+        
+    def test_idle_loop_stopped(self):
+        with self.assertRaises(EmulationStopped):
+            while True:
+                sleep(50)
+        self.assertEqual(state._State__get_runtime(), 
+                            50 * state.clock.idle_sleeps)
+        
+    def test_changing_variables_not_idle(self):
+        report = self.run_source('n = 0\n'
+                                 'while True:\n'
+                                 '    n += 1\n'
+                                 '    if n == 10:\n'
+                                 "        display.scroll('X')\n"
+                                 '        break\n'
+                                 '    sleep(50)\n')
+        self.assertEqual(report['status'], 'finished')
+        self.assertEqual(report['frames'], 2)
+        
+    def test_changing_objects_not_idle(self):
+        report = self.run_source('class Counter:\n'
+                                 '    def __init__(self):\n'
+                                 '        self.n = 0\n'
+                                 'def main(counter):\n'
+                                 '    while counter.n < 10:\n'
+                                 '        counter.n += 1\n'
+                                 '        sleep(50)\n'
+                                 'main(Counter())\n')
+        self.assertEqual(report['status'], 'finished')
+        self.assertEqual(report['running_time'], 500)
+                
+    def test_running_time_not_idle(self):
+        start = running_time()
+        while running_time() - start < 1000:
+            sleep(50)
+            
+    def test_scheduled_event_in_virtual_mode(self):
+        state.clock = Clock('virtual')
+        state.schedule(100, { 'pin0':5 })
+        sleep(50)
+        self.assertEqual(state.get('pin0'), 0)
+        sleep(50)
+        self.assertEqual(state.get('pin0'), 5)
+        
+    def test_invalid_scheduled_value(self):
+        with self.assertRaises(ValueError):
+            state.schedule(100, { 'pin0':-1 })
+        
+
+class TestScenario(unittest.TestCase):
+    def setUp(self):
+        init(True)
+        self.clock = state.clock
+        state.clock = Clock('virtual')
+        state.power_off()
+        self.events = [(0, 'button_a', 0), (100, 'button_a', 1), 
+                        (200, 'button_a', 0), (200, 'pin0', 512)]
+        
+    def tearDown(self):
+        state.play(None)
+        state.clock = self.clock
+        
+    def check_timeline(self):
+        self.assertFalse(button_a.is_pressed())
+        sleep(100)
+        self.assertTrue(button_a.is_pressed())
+        sleep(50)
+        self.assertTrue(button_a.is_pressed())
+        self.assertEqual(state.get('pin0'), 0)
+        sleep(50)
+        self.assertFalse(button_a.is_pressed())
+        self.assertEqual(state.get('pin0'), 512)
+        
+    def test_scenario(self):
+        state.play(self.events)
+        self.check_timeline()
+        
+    def test_streamed_scenario_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, 'scenario.jsonl')
+            with open(filename, 'w') as f:
+                for event in self.events:
+                    f.write(json.dumps(event) + '\n')
+                    
+            state.play(filename, True)
+            self.check_timeline()
+            state.power_off()
+            self.check_timeline()
+            
+    def test_set_after_event(self):
+        state.play(self.events)
+        sleep(200)
+        state.set('pin0', 1)
+        self.assertEqual(state.get('pin0'), 1)
+        
+    def test_snapshot(self):
+        state.play(self.events)
+        sleep(200)
+        self.assertEqual(state.snapshot()['pin0'], 512)
+        self.assertIn('pin0:512', str(state).split('\n'))
+        state.set('pin0', 1)
+        self.assertEqual(state.snapshot()['pin0'], 1)
+        
+    def test_subscribers_notified(self):
+        state.play(self.events)
+        changes = state.subscribe(['button_a', 'pin0'])
+        sleep(100)
+        self.assertEqual(changes.get_nowait(), [('button_a', 1)])
+        sleep(100)
+        self.assertEqual(changes.get_nowait(), 
+                            [('button_a', 0), ('pin0', 512)])
+        sleep(100)
+        self.assertTrue(changes.empty())
+        state.unsubscribe(changes)
+        
+    def test_next_time(self):
+        scenario = Scenario(self.events)
+        self.assertEqual(scenario.next_time(0), 100)
+        self.assertEqual(scenario.next_time(100), 200)
+        self.assertIsNone(scenario.next_time(200))
+        self.assertEqual(scenario.value_at('button_a', 150), (100, 1))
+        
+    def test_invalid_events(self):
+        with self.assertRaises(ValueError):
+            state.play([(0, 'pin0', 2000)])
+        with self.assertRaises(ValueError):
+            state.play([(100, 'pin0', 1), (0, 'pin0', 0)])
+        with self.assertRaises(ValueError):
+            state.play([(0, 'pin99', 1)])
+        for event in [(10, 5, 1), (10, 'pin0', 'high'), (10, 'pin0', None),
+                        ('10', 'pin0', 1), (10, 'pin0'), 10]:
+            with self.assertRaisesRegex(ValueError, 'invalid scenario event'):
+                state.play([event])
+        
+
+class TestRunBudget(unittest.TestCase):
+    def setUp(self):
+        init(True)
+        self.clock = state.clock
+        state.clock = Clock('virtual')
+        state.power_off()
+        
+    def tearDown(self):
+        state.budget()
+        state.clock = self.clock
+        
+    def loop(self):
+        while True:
+            display.show(Image.HAPPY)
+            sleep(200)
+            
+    def test_ms_budget(self):
+        report = run_program(self.loop, ms=1000)
+        self.assertEqual(report, { 'status':'budget', 'running_time':1000,
+                                    'sleeps':5, 'frames':5 })
+        
+    def test_sleeps_budget(self):
+        report = run_program(self.loop, sleeps=3)
+        self.assertEqual(report['status'], 'budget')
+        self.assertEqual(report['sleeps'], 3)
+        
+    def test_frames_budget(self):
+        report = run_program(self.loop, frames=3)
+        self.assertEqual(report['status'], 'budget')
+        self.assertEqual(report['frames'], 3)
+        self.assertEqual(report['sleeps'], 2)
+        
+    def test_budget_not_caught_by_program(self):
+        def program():
+            try:
+                self.loop()
+            except Exception:
+                pass
+        self.assertEqual(run_program(program, sleeps=1)['status'], 'budget')
+        
+    def test_program_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, 'program.py')
+            with open(filename, 'w') as f:
+                f.write('from microbit_stub import *\n'
+                        'sleep(100)\n'
+                        'raise ValueError("bad")\n')
+            report = run_program(filename, ms=1000)
+        self.assertEqual(report['status'], 'error')
+        self.assertEqual(report['running_time'], 100)
+        self.assertIn('bad', report['error'])
+        
+    def test_finished(self):
+        report = run_program(lambda: sleep(10))
+        self.assertEqual(report['status'], 'finished')
+        with self.assertRaises(BudgetExhausted):
+            state.budget(sleeps=1)
+            sleep(10)
+        
+
+class TestDevice(unittest.TestCase):
+    def setUp(self):
+        init(True)
+        
+    def test_devices_isolated(self):
+        first = Device(state_backend='memory')
+        second = Device(state_backend='memory')
+        
+        with first:
+            pin0.write_analog(100)
+            button_a.was_pressed()
+            state.press('button_a')
+            self.assertIs(Device.current(), first)
+            
+        with second:
+            self.assertEqual(pin0.read_analog(), 0)
+            self.assertFalse(button_a.was_pressed())
+            display.show(Image.HAPPY)
+            
+        self.assertEqual(first.pin0.read_analog(), 100)
+        self.assertEqual(first.state.get('button_a_presses'), 1)
+        self.assertEqual(second.display.image, Image.HAPPY)
+        self.assertNotEqual(first.display.image, Image.HAPPY)
+        
+    def test_sleeps_use_own_device(self):
+        device = Device(state_backend='memory', clock=Clock('virtual'),
+                        display_sink='null')
+        default = state._State__now()
+        device.state.budget(sleeps=10)
+        
+        start = time.monotonic()
+        device.state.press_and_release('button_a', 500)
+        device.display.show('abc', delay=200)
+        self.assertLess(time.monotonic() - start, 0.3)
+        
+        self.assertEqual(device.state._State__now(), 1600)
+        self.assertEqual(device.state.progress()['sleeps'], 5)
+        self.assertEqual(state._State__now(), default)
+        with self.assertRaises(BudgetExhausted):
+            device.display.scroll('abcdef', delay=10)
+        device.state.budget()
+        
+    def test_default_device_restored(self):
+        default = Device.current()
+        with Device(state_backend='memory') as device:
+            with Device(state_backend='memory'):
+                pass
+            self.assertIs(Device.current(), device)
+        self.assertIs(Device.current(), default)
+        
+    def test_device_per_thread(self):
+        results = {}
+        
+        def program(i):
+            with Device(state_backend='memory', clock=Clock('virtual')):
+                pin0.write_analog(i)
+                sleep(100)
+                results[i] = (pin0.read_analog(), running_time())
+            
+        threads = [threading.Thread(target=program, args=(i,)) 
+                    for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+            
+        self.assertEqual(results, { i:(i, 101) for i in range(10) })
+        
+    def test_run_program(self):
+        device = Device(state_backend='memory', clock=Clock('virtual'))
+        
+        def program():
+            while True:
+                display.scroll('hi')
+                
+        frames = state.progress()['frames']
+        report = device.run_program(program, frames=10)
+        self.assertEqual(report['status'], 'budget')
+        self.assertEqual(report['frames'], 10)
+        self.assertEqual(state.progress()['frames'], frames)
+        
+
+class TestDisplaySink(unittest.TestCase):
+    def setUp(self):
+        init(True)
+        
+    def run_display(self, device):
+        with device:
+            display.set_pixel(0, 0, 9)
+            display.show(Image.HAPPY)
+            sleep(100)
+            display.scroll('ab', delay=0)
+            state.power_off()
+            display.show(Image.SAD)
+            
+    def test_text(self):
+        stream = io.StringIO()
+        self.run_display(Device(state_backend='memory', 
+                                display_sink=TextSink(stream)))
+        self.assertEqual(stream.getvalue(), 
+            ''.join(str(img) + '\n' for img in 
+                    [Image('90000:00000:00000:00000:00000:'), Image.HAPPY, 
+                     Image.CHARACTER_MAP['a'], Image.CHARACTER_MAP['b'], 
+                     Image()]))
+        
+    def test_text_buffered(self):
+        stream = io.StringIO()
+        sink = TextSink(stream, buffer_size=1000, latency=None)
+        frame = str(Image.HAPPY) + '\n'
+        with Device(state_backend='memory', clock=Clock('virtual'), 
+                    display_sink=sink):
+            for i in range(20):
+                display.show(Image.HAPPY if i % 2 else Image.SAD)
+            self.assertEqual(len(stream.getvalue()), 
+                                len(frame) * (1000 // len(frame) + 1))
+            self.assertEqual(sink.stats(), { 'frames': 20, 'writes': 1 })
+            sleep(10)
+            self.assertEqual(len(stream.getvalue()), len(frame) * 20)
+            self.assertEqual(sink.stats(), { 'frames': 20, 'writes': 2 })
+            sleep(10)
+            self.assertEqual(sink.stats()['writes'], 2)
+            
+    def test_text_latency(self):
+        stream = io.StringIO()
+        sink = TextSink(stream, buffer_size=1000, latency=20)
+        sink.frame(Image.HAPPY, 0)
+        sink.frame(Image.SAD, 0)
+        self.assertEqual(stream.getvalue(), '')
+        time.sleep(0.2)
+        self.assertEqual(stream.getvalue(), 
+                            str(Image.HAPPY) + '\n' + str(Image.SAD) + '\n')
+        self.assertEqual(sink.stats()['writes'], 1)
+        
+    def test_text_shared_flusher(self):
+        streams = [io.StringIO() for i in range(2)]
+        sinks = [TextSink(stream, buffer_size=1000, latency=10) 
+                    for stream in streams]
+        for i in range(3):
+            for sink in sinks:
+                sink.frame(Image.HAPPY, 0)
+            time.sleep(0.1)
+            
+        for sink, stream in zip(sinks, streams):
+            self.assertEqual(sink.stats()['writes'], 3)
+            self.assertEqual(stream.getvalue(), 3 * (str(Image.HAPPY) + '\n'))
+        flushers = [t for t in threading.enumerate() 
+                        if t.name == 'TextSink flusher']
+        self.assertEqual(len(flushers), 1)
+        
+        # sinks are not kept for the exit flush once unused
+        del sink
+        ref = weakref.ref(sinks.pop())
+        gc.collect()
+        self.assertIsNone(ref())
+        
+    def test_null(self):
+        device = Device(state_backend='memory', display_sink='null')
+        self.assertIsInstance(device.display.sink, NullSink)
+        stream = io.StringIO()
+        with contextlib.redirect_stdout(stream):
+            self.run_display(device)
+        self.assertEqual(stream.getvalue(), '')
+        self.assertEqual(device.display.image, Image.SAD)
+        
+    def test_frames(self):
+        device = Device(state_backend='memory', clock=Clock('virtual'),
+                        display_sink='frames')
+        self.run_display(device)
+        self.assertEqual(device.display.sink.frames, 
+            [(0, Image('90000:00000:00000:00000:00000:')), (0, Image.HAPPY), 
+             (100, Image.CHARACTER_MAP['a']), (100, Image.CHARACTER_MAP['b']),
+             (100, Image())])
+        
+    def test_recorder(self):
+        buffer = io.BytesIO()
+        sink = RecorderSink(buffer)
+        self.run_display(Device(state_backend='memory', 
+                                clock=Clock('virtual'), display_sink=sink))
+        sink.flush()
+        self.assertEqual(len(buffer.getvalue()), 5 * (6 + 25))
+        buffer.seek(0)
+        self.assertEqual(list(RecorderSink.read(buffer)), 
+            [(0, Image('90000:00000:00000:00000:00000:')), (0, Image.HAPPY), 
+             (100, Image.CHARACTER_MAP['a']), (100, Image.CHARACTER_MAP['b']),
+             (100, Image())])
+        sink.close()
+        
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            Device(state_backend='memory', display_sink='printer')
+        
+        
+class TestAsync(unittest.TestCase):
+    def setUp(self):
+        init(True)
+        
+    def test_sleep_async_virtual(self):
+        async def main():
+            with Device(state_backend='memory', clock=Clock('virtual')):
+                start = running_time()
+                await sleep_async(1000)
+                return running_time() - start
+        
+        self.assertEqual(asyncio.run(main()), 1001)
+        
+    def test_sleep_async_real(self):
+        async def main():
+            with Device(state_backend='memory', clock=Clock('real', 10)):
+                await asyncio.gather(sleep_async(500),
+                                        asyncio.sleep(0.05))
+        
+        start = time.monotonic()
+        asyncio.run(main())
+        self.assertLess(time.monotonic() - start, 0.09)
+        
+    def test_many_devices(self):
+        order = []
+        
+        async def program(i):
+            with Device(state_backend='memory', clock=Clock('virtual')):
+                for n in range(3):
+                    pin0.write_analog(i * 10 + n)
+                    await display.show_async([Image.HAPPY, Image.SAD], 
+                                                delay=100)
+                    order.append(i)
+                await display.scroll_async('ab')
+                return pin0.read_analog(), running_time(), display.image
+        
+        async def main():
+            return await asyncio.gather(*(program(i) for i in range(100)))
+        
+        results = asyncio.run(main())
+        self.assertEqual(results, [(i * 10 + 2, 1401, Image()) 
+                                    for i in range(100)])
+        # the devices take turns on each sleep
+        self.assertEqual(order[:100], list(range(100)))
+        
+    def test_run_program_async(self):
+        async def coroutine_program():
+            while True:
+                await sleep_async(10)
+                
+        def blocking_program():
+            while True:
+                display.scroll('hi')
+        
+        async def main():
+            first = Device(state_backend='memory', clock=Clock('virtual'))
+            second = Device(state_backend='memory', clock=Clock('virtual'))
+            return await asyncio.gather(
+                first.run_program_async(coroutine_program, sleeps=5),
+                second.run_program_async(blocking_program, frames=10))
+        
+        first, second = asyncio.run(main())
+        self.assertEqual(first['status'], 'budget')
+        self.assertEqual(first['sleeps'], 5)
+        self.assertEqual(second['status'], 'budget')
+        self.assertEqual(second['frames'], 10)
+        
+    def test_run_program_file_async(self):
+        devices = [Device(state_backend='memory', clock=Clock('virtual')) 
+                    for i in range(2)]
+        
+        async def main(filename):
+            return await asyncio.gather(*(device.run_program_async(
+                                filename, frames=10) for device in devices))
+        
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, 'program.py')
+            with open(filename, 'w') as f:
+                f.write('from microbit_stub import *\n'
+                        'import threading\n'
+                        'main = threading.current_thread() is '
+                        'threading.main_thread()\n'
+                        'pin0.write_digital(int(main))\n'
+                        'while True:\n'
+                        "    display.scroll('hi')\n")
+            reports = asyncio.run(main(filename))
+            
+        for device, report in zip(devices, reports):
+            self.assertEqual(report['status'], 'budget')
+            self.assertEqual(report['frames'], 10)
+            # run cooperatively rather than in a thread
+            self.assertEqual(device.pin0.read_digital(), 1)
+            
+    def test_virtual_wakeups_ordered(self):
+        wakeups = []
+        
+        def program(name, ms):
+            async def run():
+                while True:
+                    await sleep_async(ms)
+                    wakeups.append((state._State__now(), name))
+            return run
+        
+        async def main():
+            devices = [Device(state_backend='memory', clock=Clock('virtual'))
+                        for i in range(2)]
+            return await asyncio.gather(
+                devices[0].run_program_async(program('a', 30), ms=300),
+                devices[1].run_program_async(program('b', 20), ms=300))
+        
+        asyncio.run(main())
+        times = [t for t, name in wakeups]
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(times[:4], [20, 30, 40, 60])
+        
+        
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        init(True)
+        self.dir = tempfile.TemporaryDirectory()
+        
+    def tearDown(self):
+        self.dir.cleanup()
+        
+    def write_program(self, name, source):
+        filename = os.path.join(self.dir.name, name)
+        with open(filename, 'w') as f:
+            f.write(source)
+        return filename
+        
+    def test_compile_program(self):
+        filename = self.write_program('count.py', 
+            'from microbit_stub import *\n'
+            'import microbit_stub\n'
+            'count = 0\n'
+            'def tick(n):\n'
+            '    global count\n'
+            '    count = count + n\n'
+            '    pin0.write_analog(count)\n'
+            '    microbit_stub.sleep(100)\n'
+            'def twice():\n'
+            '    tick(1)\n'
+            '    tick(2)\n'
+            'while count < 9:\n'
+            '    twice()\n'
+            '    display.show(Image.HAPPY)\n'
+            'display.scroll("ab", delay=50)\n'
+            'pin1.write_analog(sum([count for i in range(2)]))\n')
+        program = compile_program(filename)
+        steps = list(program())
+        self.assertEqual(steps, [100] * 6 + [50] * 2)
+        
+        device = Device(state_backend='memory', clock=Clock('virtual'))
+        scheduler = Scheduler()
+        report = scheduler.add(program, device)
+        self.assertEqual(report, {})
+        scheduler.run()
+        self.assertEqual(report, { 'status': 'finished', 'running_time': 700,
+                                    'sleeps': 8, 'frames': 6 })
+        self.assertEqual(device.pin0.read_analog(), 9)
+        self.assertEqual(device.pin1.read_analog(), 18)
+        
+    def test_indirect_calls(self):
+        filename = self.write_program('handlers.py', 
+            'from microbit_stub import *\n'
+            'def flash(image):\n'
+            '    display.show(image)\n'
+            '    sleep(100)\n'
+            '    display.clear()\n'
+            '    sleep(100)\n'
+            'def both():\n'
+            '    flash(Image.HAPPY)\n'
+            '    [flash(i) for i in (Image.SAD, Image.YES)]\n'
+            'handlers = { "a": both }\n'
+            'show = flash\n'
+            'handlers["a"]()\n'
+            'show(Image.NO)\n'
+            'both()\n')
+        blocking = Device(state_backend='memory', clock=Clock('virtual'),
+                            display_sink='null')
+        expected = blocking.run_program(filename)
+        self.assertEqual(expected['frames'], 14)
+        
+        device = Device(state_backend='memory', clock=Clock('virtual'),
+                        display_sink='null')
+        scheduler = Scheduler()
+        report = scheduler.add(compile_program(filename), device)
+        scheduler.run()
+        self.assertEqual(report, expected)
+        
+    def test_interleaved(self):
+        filename = self.write_program('ticks.py', 
+            'import sys\n'
+            'from microbit_stub import *\n'
+            'name, period = sys.argv[0], int(sys.argv[1])\n'
+            'while True:\n'
+            '    print(name, running_time())\n'
+            '    sleep(period)\n')
+        program = compile_program(filename)
+        scheduler = Scheduler()
+        
+        def ticks(period):
+            def run():
+                sys.argv = ['ticks' + str(period), str(period)]
+                return program()
+            return run
+        
+        reports = [scheduler.add(ticks(period), ms=300) 
+                    for period in (100, 150)]
+        argv = sys.argv
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                scheduler.run()
+        finally:
+            sys.argv = argv
+            
+        self.assertEqual(output.getvalue().split('\n'), 
+                            ['ticks100 1', 'ticks150 1', 
+                             'ticks100 102', 'ticks150 152', 
+                             'ticks100 203', ''])
+        self.assertEqual([r['status'] for r in reports], ['budget'] * 2)
+        
+    def test_many_programs(self):
+        filename = self.write_program('happysad.py', 
+                        open('happysad.py').read())
+        program = compile_program(filename)
+        scheduler = Scheduler()
+        reports = [scheduler.add(program, ms=2000) for i in range(1000)]
+        scheduler.run()
+        self.assertEqual(reports, [{ 'status': 'budget', 
+                                    'running_time': 2000, 'sleeps': 10, 
+                                    'frames': 10 }] * 1000)
+        
+    def test_error(self):
+        filename = self.write_program('error.py', 
+            'from microbit_stub import *\n'
+            'sleep(10)\n'
+            'raise ValueError("bad")\n')
+        scheduler = Scheduler()
+        report = scheduler.add(filename)
+        scheduler.run()
+        self.assertEqual(report['status'], 'error')
+        self.assertEqual(report['error'], "ValueError('bad')")
+        
+        
+class TestGrade(unittest.TestCase):
+    def setUp(self):
+        init(True)
+        self.dir = tempfile.TemporaryDirectory()
+        
+    def tearDown(self):
+        self.dir.cleanup()
+        
+    def write_file(self, name, text):
+        filename = os.path.join(self.dir.name, name)
+        with open(filename, 'w') as f:
+            f.write(text)
+        return filename
+        
+    def test_bad_scenario(self):
+        program = self.write_file('happysad.py', open('happysad.py').read())
+        bad = self.write_file('bad.jsonl', '[10, 5, 1]\n')
+        good = self.write_file('press.jsonl', '[300, "button_a", 1]\n')
+        
+        for results in (microbit_stub_grade.grade([program], [bad, good], 
+                                                    workers=2, ms=1000),
+                        microbit_stub_grade.fork_grade(program, [bad, good],
+                                                        ms=1000)):
+            results = { r['scenario']:r for r in results }
+            self.assertEqual(results[bad]['status'], 'error')
+            self.assertIn('error', results[bad])
+            self.assertEqual(results[good]['status'], 'budget')
+        
+    def test_grade(self):
+        programs = os.path.join(self.dir.name, 'programs')
+        os.mkdir(programs)
+        self.write_file(os.path.join('programs', 'count.py'), 
+            'from microbit_stub import *\n'
+            'while not button_a.is_pressed():\n'
+            '    pin0.write_analog(pin0.read_analog() + 1)\n'
+            '    sleep(100)\n'
+            'display.show(Image.HAPPY)\n')
+        self.write_file(os.path.join('programs', 'error.py'), 
+            'raise ValueError("bad")\n')
+        self.write_file(os.path.join('programs', 'busy.py'), 
+            'while True:\n'
+            '    pass\n')
+        self.write_file(os.path.join('programs', 'greedy.py'), 
+            'data = bytearray(1 << 32)\n')
+        scenario = self.write_file('press.jsonl', '[1000, "button_a", 1]\n')
+        
+        results = list(microbit_stub_grade.grade(
+                        microbit_stub_grade.programs_in(programs), 
+                        [scenario, None], workers=2, ms=5000, cpu_limit=1))
+        results = { (os.path.basename(r['program']), r['scenario']):r 
+                    for r in results }
+        self.assertEqual(len(results), 8)
+        
+        pressed = results[('count.py', scenario)]
+        self.assertEqual(pressed['status'], 'finished')
+        self.assertEqual(pressed['running_time'], 1000)
+        self.assertEqual(pressed['state']['pin0'], 10)
+        self.assertEqual(pressed['images'], [[1000, repr(Image.HAPPY)]])
+        self.assertEqual(pressed['output'], '')
+        unpressed = results[('count.py', None)]
+        self.assertEqual(unpressed['status'], 'budget')
+        self.assertEqual(unpressed['state']['pin0'], 50)
+        
+        self.assertEqual(results[('error.py', None)]['error'], 
+                            "ValueError('bad')")
+        self.assertEqual(results[('busy.py', None)]['status'], 'cpu')
+        self.assertEqual(results[('greedy.py', None)]['error'], 
+                            'MemoryError()')
+        # runs do not share the state file
+        self.assertEqual(state.get('pin0'), 0)
+        
+    def test_fork_grade(self):
+        program = self.write_file('count.py', 
+            'import os\n'
+            'from microbit_stub import *\n'
+            'while not button_a.is_pressed():\n'
+            '    display.scroll("counting" * 100, delay=0)\n'
+            '    pin0.write_analog(pin0.read_analog() + 1)\n'
+            '    sleep(100)\n'
+            'if button_b.is_pressed():\n'
+            '    os._exit(1)\n')
+        scenarios = [self.write_file('press{0}.jsonl'.format(i), 
+                        '[{0}, "button_a", 1]\n'.format(i * 100))
+                        for i in range(1, 6)]
+        scenarios.append(self.write_file('crash.jsonl', 
+                            '[0, "button_a", 1]\n[0, "button_b", 1]\n'))
+        
+        results = list(microbit_stub_grade.fork_grade(program, scenarios, 
+                                                        workers=3))
+        results = { r['scenario']:r for r in results }
+        self.assertEqual(len(results), 6)
+        for i in range(1, 6):
+            result = results[scenarios[i - 1]]
+            self.assertEqual(result['status'], 'finished')
+            self.assertEqual(result['state']['pin0'], i)
+            self.assertEqual(len(result['images']), 801 * i)
+        self.assertEqual(results[scenarios[-1]]['status'], 'crashed')
+        
+        errors = list(microbit_stub_grade.fork_grade(
+                        self.write_file('syntax.py', 'while True\n'), [None]))
+        self.assertEqual(errors[0]['status'], 'error')
+        
+    def test_cache(self):
+        cache = microbit_stub_grade.ResultCache(
+                    os.path.join(self.dir.name, 'cache'))
+        program = self.write_file('happysad.py', open('happysad.py').read())
+        copy = self.write_file('copy.py', open('happysad.py').read())
+        scenario = self.write_file('press.jsonl', '[300, "button_a", 1]\n')
+        
+        first = list(microbit_stub_grade.grade([program], [scenario, None], 
+                                                ms=1000, cache=cache))
+        self.assertEqual(cache.stats(), { 'hits': 0, 'misses': 2, 
+                                            'stores': 2, 'evictions': 0 })
+        
+        again = list(microbit_stub_grade.fork_grade(copy, [scenario, None], 
+                                                    ms=1000, cache=cache))
+        self.assertEqual(cache.stats()['hits'], 2)
+        for result in again:
+            self.assertEqual(result['program'], copy)
+            self.assertTrue(result.pop('cached'))
+            result['program'] = program
+        key = lambda r: str(r['scenario'])
+        self.assertEqual(sorted(again, key=key), sorted(first, key=key))
+        
+        # a different budget is a different run
+        list(microbit_stub_grade.grade([program], [None], ms=2000, 
+                                        cache=cache))
+        self.assertEqual(cache.stats()['misses'], 3)
+        
+        # least recently used results are evicted
+        size = cache.size()
+        small = microbit_stub_grade.ResultCache(cache.directory, size)
+        self.assertEqual(small.size(), size)
+        hits = list(microbit_stub_grade.grade([program], [scenario], 
+                                                ms=1000, cache=small))
+        self.assertTrue(hits[0]['cached'])
+        list(microbit_stub_grade.grade([program], [None], ms=3000, 
+                                        cache=small))
+        self.assertGreaterEqual(small.stats()['evictions'], 1)
+        self.assertLessEqual(small.size(), size)
+        self.assertIsNotNone(small.get(small.key(program, scenario, 
+            { 'time_mode': 'virtual', 'ms': 1000, 'sleeps': None, 
+                'frames': None, 'cpu_limit': 10, 
+                'state_backend': 'memory', 
+                'memory_limit': microbit_stub_grade.MEMORY_LIMIT_DEFAULT })))
+        
+    def test_cache_key(self):
+        cache = microbit_stub_grade.ResultCache(
+                    os.path.join(self.dir.name, 'cache'))
+        program = self.write_file('happysad.py', open('happysad.py').read())
+        options = { 'ms': 1000, 'memory_limit': 1 << 30 }
+        key = cache.key(program, None, options)
+        
+        self.assertNotEqual(cache.key(program, None, 
+                                dict(options, memory_limit=1 << 29)), key)
+        
+        idle_sleeps = microbit_stub.idle_sleeps
+        microbit_stub.idle_sleeps = idle_sleeps + 1
+        try:
+            self.assertNotEqual(cache.key(program, None, options), key)
+        finally:
+            microbit_stub.idle_sleeps = idle_sleeps
+        self.assertEqual(cache.key(program, None, options), key)
+        
+        scenario_file = microbit_stub.scenario_file
+        microbit_stub.scenario_file = self.write_file('events.jsonl', 
+                                                    '[300, "pin0", 1]\n')
+        try:
+            with_scenario = cache.key(program, None, options)
+            self.assertNotEqual(with_scenario, key)
+            self.write_file('events.jsonl', '[300, "pin0", 2]\n')
+            self.assertNotEqual(cache.key(program, None, options), 
+                                with_scenario)
+        finally:
+            microbit_stub.scenario_file = scenario_file
+        
+    def test_main(self):
+        program = self.write_file('happysad.py', open('happysad.py').read())
+        output = os.path.join(self.dir.name, 'results.jsonl')
+        microbit_stub_grade.main([program, '--ms', '1000', 
+                                    '--state-backend', 'json', 
+                                    '--output', output])
+        with open(output) as f:
+            results = [json.loads(line) for line in f]
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['status'], 'budget')
+        self.assertEqual(results[0]['sleeps'], 5)
+        
+        
 """ ---------------------------------------------------------------------- """    
 """ panic test ----------------------------------------------------------- """
 class TestPanic(unittest.TestCase):        